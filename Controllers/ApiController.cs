@@ -6,6 +6,7 @@
 using Microsoft.AspNetCore.Http;
 using Microsoft.AspNetCore.Mvc;
 using MyHome.Systems;
+using MyHome.Systems.Devices.Sensors;
 using MyHome.Utils;
 
 using Newtonsoft.Json;
@@ -36,6 +37,15 @@ public ActionResult GetStatus()
             return this.Ok();
         }
 
+        [HttpGet("status/helpers")]
+        public ActionResult GetHelpersStatus()
+        {
+            var assistant = this.myHome.Systems[nameof(AssistantSystem)] as AssistantSystem;
+            // JToken values need Newtonsoft serialization
+            var stats = new { cameraCapture = Camera.GetCaptureStats(), assistant = assistant?.GetHelperStats() };
+            return this.Content(JsonConvert.SerializeObject(stats), MediaTypeNames.Application.Json);
+        }
+
         [HttpGet("oauth2/callback")]
         public ActionResult AuthCallback()
         {
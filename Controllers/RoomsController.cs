@@ -1,5 +1,4 @@
 ﻿using System;
-using System.Diagnostics;
 using System.Globalization;
 using System.Linq;
 
@@ -238,7 +237,7 @@ public ActionResult SetSensorData(string roomName, string sensorName, string val
 
 
         [HttpGet("{roomName}/cameras/{cameraName}/image")]
-        public void GetCameraImage(string roomName, string cameraName)
+        public void GetCameraImage(string roomName, string cameraName, int quality = 80)
         {
             var room = this.myHome.Rooms.Find(r => r.Name == roomName);
             if (room == null)
@@ -260,16 +259,11 @@ public void GetCameraImage(string roomName, string cameraName)
             {
                 this.Response.ContentType = "multipart/x-mixed-replace;boundary=frame";
 
-                Stopwatch stopwatch = new Stopwatch();
                 var task = System.Threading.Tasks.Task.CompletedTask;
-                while (true)
+                foreach (var imageBytes in camera.StreamImages(20, null, quality, this.HttpContext.RequestAborted))
                 {
-                    stopwatch.Restart();
-
-                    // fetch images while waiting to send the pervious one
-                    byte[] imageBytes = null;
-                    while (!task.IsCompleted || imageBytes == null) // get at least one image
-                        imageBytes = camera.GetImage() ?? [];
+                    if (!task.IsCompleted) // skip images while sending the previous one
+                        continue;
 
                     var header = $"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: {imageBytes.Length}\r\n\r\n";
                     var headerData = System.Text.Encoding.UTF8.GetBytes(header);
@@ -277,11 +271,6 @@ public void GetCameraImage(string roomName, string cameraName)
                     this.Response.Body.WriteAsync(headerData, 0, headerData.Length, this.HttpContext.RequestAborted);
                     this.Response.Body.WriteAsync(imageBytes, 0, imageBytes.Length, this.HttpContext.RequestAborted);
                     task = this.Response.Body.WriteAsync(newLine, 0, newLine.Length, this.HttpContext.RequestAborted);
-
-                    if (this.HttpContext.RequestAborted.IsCancellationRequested)
-                        break;
-                    if (stopwatch.Elapsed < TimeSpan.FromMilliseconds(50)) // sleep to 50 ms for 20 FPS
-                        System.Threading.Thread.Sleep(50 - (int)stopwatch.ElapsedMilliseconds);
                 }
             }
             catch (OperationCanceledException)
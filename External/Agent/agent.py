@@ -1,16 +1,21 @@
+import asyncio
 import base64
+import itertools
 import json
 import logging
 import os
 import socket
-import time
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import paho.mqtt.client
-import psutil
 import wakeonlan
 
 import utils
+from mediaIndex import MediaIndex
+from telemetry import TelemetryCollector
+
+
+MEDIA_INDEX_FILE = "media.db"
 
 
 class Agent:
@@ -20,14 +25,25 @@ class Agent:
     def __init__(self, config):
         self._config = config
         self._hostname = socket.gethostname()
-        self._next_update = datetime.now()
-        self._next_update_2 = datetime.now()
-        self._media_refresh_time = datetime.now()
 
+        self._loop = None
         self._mqtt = paho.mqtt.client.Client(self._hostname + "Client")
         self._media_player = None
+        self._media_changed = None  # set by the media player events
+        self._media_state = None
+        self._media_index = None
+        self._media_list_synced = None  # if the retained full list is up to date, None - not published yet
         self._cec = None
         self._cec_devices = {}
+        self._cec_states = {}  # cached devices info by address, updated by the commands and the refresh
+        self._cec_refresh = None
+        self._cec_executor = ThreadPoolExecutor(1)  # CEC calls are serialized
+        self._commands = None  # (id, kind, payload) processed one by one by the command worker
+        self._command_ids = itertools.count(1)
+        self._current_command = None  # (id, task)
+        self._cancelled_commands = set()
+        self._telemetry = None
+        self._telemetry_executor = ThreadPoolExecutor(1)  # the collector isn't thread-safe
 
     def setup(self):
         self._mqtt.on_connect = self._mqtt_on_connect
@@ -39,7 +55,16 @@ class Agent:
 
         self._mqtt.loop_start()
 
+        # samples every sample_interval seconds, a window is published every update_interval minutes
+        window = int(self._config["AGENT"]["update_interval"]) * 60
+        sample_interval = max(int(self._config["AGENT"].get("sample_interval", 10)), 1)
+        self._telemetry = TelemetryCollector(max(window // sample_interval, 1),
+                                             int(self._config["AGENT"].get("telemetry_backlog", 288)))
+
         self._media_player = utils.init_media_player()
+        if self._media_player is not None:
+            utils.attach_media_player_events(self._media_player, self._media_player_event)
+            self._media_index = MediaIndex(MEDIA_INDEX_FILE, Agent.SupportedMediaFormats)
         self._cec = utils.init_cec()
 
         features = {"telemetry": True, "CEC": self._cec is not None,
@@ -48,28 +73,64 @@ class Agent:
         self._mqtt.publish(
             f"tele/{self._hostname}/FEATURES", json.dumps(features), retain=True)
 
-    def update(self):
-        self._update_media()
-
-        if datetime.now() > self._next_update:
-            self._next_update = datetime.now(
-            ) + timedelta(minutes=int(self._config["AGENT"]["update_interval"]))
-
-            self._send_telemetry()
-
-            if datetime.now() > self._media_refresh_time:
-                self._media_refresh_time = datetime.now() + timedelta(days=1)
-                self._update_media_list()
-
-        if datetime.now() > self._next_update_2:
-            self._next_update_2 = datetime.now(
-            ) + timedelta(minutes=int(self._config["AGENT"]["update_2_interval"]))
-
-            self._update_cec_devices()
+    async def run(self):
+        # independent periodic tasks, blocking work runs in executors, so a slow call doesn't stall the others
+        self._loop = asyncio.get_running_loop()
+        self._media_changed = asyncio.Event()
+        self._commands = asyncio.Queue()
+        self.setup()
+        try:
+            await asyncio.gather(
+                self._every(int(self._config["AGENT"].get("sample_interval", 10)), self._sample_telemetry,
+                            self._telemetry_executor),
+                self._every(int(self._config["AGENT"]["update_interval"]) * 60, self._send_telemetry,
+                            self._telemetry_executor),
+                self._every(int(self._config["AGENT"]["update_2_interval"]) * 60, self._update_cec_devices),
+                self._every(int(self._config.get("MEDIA", {}).get("scan_interval", 60)) * 60, self._update_media_list),
+                self._every(24 * 60 * 60, self._publish_media_list),
+                self._media_loop(),
+                self._command_worker())
+        finally:
+            self.stop()
 
     def stop(self):
         self._mqtt.loop_stop()
         self._mqtt.disconnect()
+        self._cec_executor.shutdown(wait=False)
+        self._telemetry_executor.shutdown(wait=False)
+        if self._media_index is not None:
+            self._media_index.close()
+
+    async def _every(self, interval, func, executor=None):
+        while True:
+            start = self._loop.time()
+            if asyncio.iscoroutinefunction(func):
+                await func()
+            else:
+                await self._loop.run_in_executor(executor, func)
+            elapsed = self._loop.time() - start
+            if elapsed > min(interval, 1):
+                logging.info(f"{func.__name__}: {elapsed} sec")
+            await asyncio.sleep(max(0.0, interval - elapsed))
+
+    async def _media_loop(self):
+        if self._media_player is None:
+            return
+
+        interval = float(self._config["AGENT"]["sleep_time"])
+        while True:
+            self._media_changed.clear()
+            await self._loop.run_in_executor(None, self._update_media)
+            # while playing send the position every interval, otherwise wait for the player events
+            playing = self._media_state not in (None, "State.NothingSpecial", "State.Stopped")
+            try:
+                await asyncio.wait_for(self._media_changed.wait(), interval if playing else None)
+            except asyncio.TimeoutError:
+                pass
+
+    def _media_player_event(self, event):
+        # called from a VLC thread, the player mustn't be used here
+        self._loop.call_soon_threadsafe(self._media_changed.set)
 
     def _mqtt_on_connect(self, client, userdata, flags, rc):
         logging.debug(
@@ -78,149 +139,220 @@ class Agent:
         self._mqtt.subscribe(f"cmnd/{self._hostname}/cec")
         self._mqtt.subscribe(f"cmnd/{self._hostname}/media")
 
+        # replay the telemetry windows collected while disconnected
+        if self._telemetry is not None:
+            self._telemetry_executor.submit(self._publish_telemetry)
+
     @utils.try_catch()
     def _mqtt_on_message(self, client, userdata, msg):
+        # called from the MQTT client thread
         logging.info(
             f"MQTT message received with topic '{msg.topic}': {msg.payload}")
 
         payload = json.loads(msg.payload.decode())
-        if msg.topic == f"cmnd/{self._hostname}/cec":
-            self._handle_cec_cmd(payload)
-        if msg.topic == f"cmnd/{self._hostname}/media":
-            self._handle_media_cmd(payload)
+        kind = msg.topic.split("/")[-1]
+        if kind in ("cec", "media"):
+            self._loop.call_soon_threadsafe(self._enqueue_command, kind, payload)
+
+    def _enqueue_command(self, kind, payload):
+        # {"cancel": id} cancels a queued or running command, other commands can have an "id" for the result
+        if "cancel" in payload:
+            self._cancelled_commands.add(payload["cancel"])
+            if self._current_command is not None and self._current_command[0] == payload["cancel"]:
+                self._current_command[1].cancel()
+            return
+
+        command_id = payload.pop("id", None)
+        self._commands.put_nowait((command_id if command_id is not None else next(self._command_ids), kind, payload))
+
+    async def _command_worker(self):
+        handlers = {"cec": self._handle_cec_cmd, "media": self._handle_media_cmd}
+        timeout = float(self._config["AGENT"].get("command_timeout", 30))
+        while True:
+            command_id, kind, payload = await self._commands.get()
+            if command_id in self._cancelled_commands:
+                self._cancelled_commands.discard(command_id)
+                self._publish_command_result(command_id, kind, "cancelled")
+                continue
+
+            task = asyncio.ensure_future(handlers[kind](payload))
+            self._current_command = (command_id, task)
+            try:
+                result = await asyncio.wait_for(task, timeout)
+                self._publish_command_result(command_id, kind, "done", result)
+            except asyncio.TimeoutError:
+                logging.warning(f"Command {command_id} ({kind}) timed out: {payload}")
+                self._publish_command_result(command_id, kind, "timeout")
+            except asyncio.CancelledError:
+                if command_id not in self._cancelled_commands:
+                    raise  # the worker is cancelled
+                self._cancelled_commands.discard(command_id)
+                self._publish_command_result(command_id, kind, "cancelled")
+            except Exception as e:
+                logging.exception(f"Failed to process command {command_id} ({kind}): {payload}")
+                self._publish_command_result(command_id, kind, "error", str(e))
+            finally:
+                self._current_command = None
+
+    def _publish_command_result(self, command_id, kind, status, result=None):
+        self._mqtt.publish(f"stat/{self._hostname}/RESULT",
+                           json.dumps({"id": command_id, "command": kind, "status": status, "result": result}, default=str))
 
     @utils.try_catch()
-    def _send_telemetry(self):
-        result = {}
-
-        output = utils.call_system(
-            ["cat /sys/class/thermal/thermal_zone0/temp"])
-        if output and output[0]:
-            result["cpu_temp"] = int(output[0]) / 1000
-
-        result["cpu_usage"] = psutil.cpu_percent()
-        result["mem_usage"] = psutil.virtual_memory().percent
-        result["disk_usage"] = {}
-        for disk in psutil.disk_partitions():
-            result["disk_usage"][disk.mountpoint] = psutil.disk_usage(
-                disk.mountpoint).percent
-        result["net_sent"] = psutil.net_io_counters().bytes_sent
-        result["net_recv"] = psutil.net_io_counters().bytes_recv
+    def _sample_telemetry(self):
+        self._telemetry.sample()
 
+    @utils.try_catch()
+    def _send_telemetry(self):
+        result = self._telemetry.close_window()
         logging.info(f"Telemetry: {result}")
-        self._mqtt.publish(f"tele/{self._hostname}/SENSOR", json.dumps(result))
+        self._publish_telemetry()
+
+    @utils.try_catch()
+    def _publish_telemetry(self):
+        # windows which fail to publish (disconnected) are kept and replayed on reconnect
+        count = self._telemetry.publish(lambda window: self._mqtt.publish(
+            f"tele/{self._hostname}/SENSOR", json.dumps(window)).rc == paho.mqtt.client.MQTT_ERR_SUCCESS)
+        if count > 1:
+            logging.info(f"Telemetry windows published: {count}")
 
     @utils.try_catch()
-    def _update_cec_devices(self):
+    async def _update_cec_devices(self):
         if self._cec is None:
             return
 
+        devices = await self._loop.run_in_executor(self._cec_executor, self._cec.list_devices)
         self._cec_devices = {
-            f"{item[1].osd_string}_{item[0]}": item[1] for item in self._cec.list_devices().items()}
-
-        devices = []
-        for item in self._cec_devices.items():
-            try:
-                is_on = item[1].is_on()
-            except:
-                is_on = None
-            devices.append({"address": item[0], "physical_address": item[1].physical_address, "cec_version": item[1].cec_version,
-                            "language": item[1].language, "is_on": is_on})
-        logging.info(f"CEC devices: {devices}")
+            f"{item[1].osd_string}_{item[0]}": item[1] for item in devices.items()}
+
+        # a call per device, so the queued commands run in between
+        for address, device in self._cec_devices.items():
+            is_on = await self._loop.run_in_executor(self._cec_executor, self._cec_is_on, device)
+            self._cec_states[address] = {"address": address, "physical_address": device.physical_address,
+                                         "cec_version": device.cec_version, "language": device.language, "is_on": is_on}
+        for address in self._cec_states.keys() - self._cec_devices.keys():
+            del self._cec_states[address]
+        logging.info(f"CEC devices: {list(self._cec_states.values())}")
+        self._publish_cec_devices()
+
+    def _cec_is_on(self, device):
+        try:
+            return device.is_on()
+        except:
+            return None
+
+    def _refresh_cec_devices(self):
+        if self._cec_refresh is None or self._cec_refresh.done():
+            self._cec_refresh = asyncio.ensure_future(self._update_cec_devices())
+
+    def _publish_cec_devices(self):
         self._mqtt.publish(
-            f"tele/{self._hostname}/CEC_DEVICES", json.dumps(devices), retain=True)
+            f"tele/{self._hostname}/CEC_DEVICES", json.dumps(list(self._cec_states.values())), retain=True)
 
     @utils.try_catch()
-    def _update_media_list(self):
+    def _update_media_list(self, full=False):
+        # full - rescan every directory and publish the whole list, otherwise only changed directories and the changes
         if "MEDIA" not in self._config or not self._media_player:
             return
 
-        media_list = {}
-        for (key, mediaPath) in self._config["MEDIA"].items():
-            if not key.startswith("path") or not os.path.isdir(mediaPath):
-                continue
-            media_list[mediaPath] = []
-            for root, _, files in os.walk(mediaPath):
-                for f in files:
-                    if os.path.splitext(f)[1] not in Agent.SupportedMediaFormats:
-                        continue
-                    path = os.path.join(root, f)
-                    media_list[mediaPath].append(
-                        (os.path.relpath(path, mediaPath), os.path.getmtime(path)))
-
-        logging.info(f"Media list: {media_list}")
+        paths = [path for (key, path) in self._config["MEDIA"].items() if key.startswith("path")]
+        self._media_index.remove_roots(paths)
+        changes = self._media_index.scan([path for path in paths if os.path.isdir(path)], full)
+        if full or self._media_list_synced is None:
+            self._publish_media_list(True)
+        elif changes:
+            logging.info(f"Media list changes: {changes}")
+            self._media_list_synced = False  # the retained list is published once a day
+            self._mqtt.publish(f"tele/{self._hostname}/MEDIA_LIST_DELTA", json.dumps(changes))
+
+    @utils.try_catch()
+    def _publish_media_list(self, force=False):
+        if "MEDIA" not in self._config or self._media_index is None or (not force and self._media_list_synced is not False):
+            return
+
+        paths = [path for (key, path) in self._config["MEDIA"].items() if key.startswith("path") and os.path.isdir(path)]
+        media_list = self._media_index.snapshot(paths)
+        logging.info(f"Media list: { {path: len(files) for path, files in media_list.items()} } files")
         self._mqtt.publish(
             f"tele/{self._hostname}/MEDIA_LIST", json.dumps(media_list), retain=True)
+        self._media_list_synced = True
 
     @utils.try_catch()
     def _update_media(self):
-        if not self._media_player or str(self._media_player.get_state()) in ("State.NothingSpecial", "State.Stopped"):
+        state = str(self._media_player.get_state()) if self._media_player else None
+        if state in (None, "State.NothingSpecial", "State.Stopped") and state == self._media_state:
             return
 
-        if str(self._media_player.get_state()) == "State.Ended":
+        if state == "State.Ended":
             self._media_player.stop()
 
-        path = self._media_player.get_media().get_mrl() if str(
+        media = self._media_player.get_media()
+        path = media.get_mrl() if media is not None and str(
             self._media_player.get_state()) != "State.Stopped" else ""
         media_info = {"playing": path, "state": str(self._media_player.get_state()), "volume": self._media_player.audio_get_volume(),
                       "time": self._media_player.get_time(), "length": self._media_player.get_length()}
-        if datetime.now() > self._next_update:
+        if media_info["state"] != self._media_state:
             logging.info(f"Media info: {media_info}")
+        self._media_state = media_info["state"]
         self._mqtt.publish(
             f"tele/{self._hostname}/MEDIA", json.dumps(media_info))
 
-    @utils.try_catch()
-    def _handle_cec_cmd(self, payload):
+    async def _handle_cec_cmd(self, payload):
         # expected payload: { "address": "...", "command": "power_on/standby/transmit", "args": [] }
         # address is not device.address, but {device.osd_string}_{device.address}
         # to change source to HDMI 2: {"command": "transmit", "args": [15, 130, "2000"]} - cec.transmit(cec.CECDEVICE_BROADCAST, cec.CEC_OPCODE_ACTIVE_SOURCE, b'\x20\x00')
         # https://www.cec-o-matic.com/
         logging.info(f"Processing CEC command: {payload}")
         if self._cec is None:
-            logging.warn("CEC is not supported")
-            return
+            raise ValueError("CEC is not supported")
 
         if "command" not in payload:
-            logging.warn("Invalid CEC command")
-            return
+            raise ValueError("Invalid CEC command")
 
         # device if address is provided else cec
-        target = self._cec_devices[payload["address"]
-                                   ] if "address" in payload and payload["address"] in self._cec_devices else self._cec
+        address = payload.get("address")
+        target = self._cec_devices[address] if address in self._cec_devices else self._cec
         func = getattr(target, payload["command"])
+        args = payload.get("args", [])
         if payload["command"] == "transmit":
-            payload["args"][-1] = bytes.fromhex(payload["args"][-1])
-        res = func(*payload["args"]) if "args" in payload else func()
+            args[-1] = bytes.fromhex(args[-1])
+        res = await self._loop.run_in_executor(self._cec_executor, lambda: func(*args))
         logging.info(f"Result: {res}")
 
-        self._update_cec_devices()
+        # the power state is known from the command, otherwise refresh in the background
+        if target is not self._cec and address in self._cec_states and payload["command"] in ("power_on", "standby"):
+            self._cec_states[address]["is_on"] = payload["command"] == "power_on"
+            self._publish_cec_devices()
+        else:
+            self._refresh_cec_devices()
+        return res
 
-    @utils.try_catch()
-    def _handle_media_cmd(self, payload):
+    async def _handle_media_cmd(self, payload):
         logging.info(f"Processing media command: {payload}")
         if self._media_player is None:
-            logging.warn("Media is not supported")
-            return
+            raise ValueError("Media is not supported")
 
         for key in payload:
             if key == "refresh" and payload["refresh"]:
-                self._update_media_list()
+                self._loop.run_in_executor(None, self._update_media_list, True)
             elif key == "play":
                 # if TV MAC address is defined try to wake it up
                 if "tv_mac" in self._config["MEDIA"]:
                     wakeonlan.send_magic_packet(self._config["MEDIA"]["tv_mac"])
                 # if cec supported - power on tv and switch to TV
                 if self._cec is not None:
-                    self._cec.set_active_source()
-                    self._cec.transmit(self._cec.CECDEVICE_BROADCAST, self._cec.CEC_OPCODE_ACTIVE_SOURCE, bytes.fromhex(self._config["MEDIA"]["cec_source"]))
-                    
+                    await self._loop.run_in_executor(self._cec_executor, self._activate_cec_source)
+                    self._refresh_cec_devices()
+
                 self._media_player.set_fullscreen(False)
                 self._media_player.set_mrl(
                     payload["play"], ":subsdec-encoding=Windows-1251")  # set default encoding to Cyrillic
                 self._media_player.play()
                 # set fullscreen after media start
-                while self._media_player.get_time() == 0:
-                    time.sleep(0.1)
+                for _ in range(100):  # up to 10 seconds
+                    if self._media_player.get_time() != 0:
+                        break
+                    await asyncio.sleep(0.1)
                 self._media_player.set_fullscreen(True)
             elif key == "stop" and payload["stop"]:
                 self._media_player.set_pause(False)
@@ -235,4 +367,8 @@ class Agent:
             elif key == "time":
                 self._media_player.set_time(int(payload["time"]))
 
-        self._update_media()
+        self._media_changed.set()
+
+    def _activate_cec_source(self):
+        self._cec.set_active_source()
+        self._cec.transmit(self._cec.CECDEVICE_BROADCAST, self._cec.CEC_OPCODE_ACTIVE_SOURCE, bytes.fromhex(self._config["MEDIA"]["cec_source"]))
@@ -1,5 +1,5 @@
-﻿import logging
-import time
+﻿import asyncio
+import logging
 from configparser import ConfigParser
 from logging.handlers import RotatingFileHandler
 
@@ -35,19 +35,9 @@ if __name__ == "__main__":
     try:
         logging.info("My Home Agent Started")
         config = read_conf(CONFIG_FILE)
-        agent = Agent(config)
-        agent.setup()
-        while True:
-            start = time.time()
-            agent.update()
-            elapsed = time.time() - start
-
-            if elapsed > 0.1:
-                logging.info(f"Update: {elapsed} sec")
-            time.sleep(max(0.0, float(config["AGENT"]["sleep_time"]) - elapsed))
+        asyncio.run(Agent(config).run())
 
     except Exception as e:
         logging.exception("Agent exception")
     finally:
-        agent.stop()
         logging.info("done\n")
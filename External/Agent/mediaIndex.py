@@ -0,0 +1,113 @@
+import logging
+import os
+import sqlite3
+import threading
+
+
+class MediaIndex:
+    # persistent index of the media files, directories with unchanged mtime are not listed again
+    def __init__(self, path, formats):
+        self._formats = formats
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, root TEXT, parent TEXT, mtime REAL);
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, root TEXT, dir TEXT, mtime REAL);
+            CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+            CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+            CREATE INDEX IF NOT EXISTS files_root ON files (root);
+        """)
+
+    def scan(self, roots, full=False):
+        # update the index and return the changes: {root: {"added": [[relative path, mtime]], "removed": [relative path]}}
+        # full - list all directories, e.g. to find files modified in place
+        changes = {}
+        with self._lock, self._db:
+            for root in roots:
+                added, removed = [], []
+                self._scan_root(root, full, added, removed)
+                if added or removed:
+                    changes[root] = {"added": added, "removed": removed}
+        return changes
+
+    def remove_roots(self, roots):
+        # remove the roots which are not configured anymore
+        with self._lock, self._db:
+            for (root,) in self._db.execute("SELECT DISTINCT root FROM dirs").fetchall():
+                if root not in roots:
+                    self._remove_dir(root, root, [])
+
+    def snapshot(self, roots):
+        # {root: [[relative path, mtime]]}
+        with self._lock:
+            return {root: [[os.path.relpath(path, root), mtime] for path, mtime in
+                           self._db.execute("SELECT path, mtime FROM files WHERE root = ?", (root,))]
+                    for root in roots}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _scan_root(self, root, full, added, removed):
+        stack = [(root, None)]
+        while stack:
+            path, parent = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:  # removed
+                self._remove_dir(path, root, removed)
+                continue
+
+            row = self._db.execute("SELECT mtime FROM dirs WHERE path = ?", (path,)).fetchone()
+            if not full and row is not None and row[0] == mtime:
+                # the directory entries are the same, only subdirectories could be changed
+                stack.extend((child, path) for (child,) in
+                             self._db.execute("SELECT path FROM dirs WHERE parent = ?", (path,)))
+                continue
+
+            # unreadable entries keep their rows and the directory is listed again on next scan
+            subdirs, files, skipped = [], {}, set()
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):  # as os.walk, symlink loops aren't followed
+                                subdirs.append(entry.path)
+                            elif os.path.splitext(entry.name)[1] in self._formats:
+                                files[entry.path] = entry.stat().st_mtime
+                        except OSError as e:  # e.g. removed meanwhile or broken symlink
+                            logging.warning(f"Skip media entry {entry.path}: {e}")
+                            skipped.add(entry.path)
+            except OSError as e:  # e.g. permission denied
+                logging.warning(f"Skip media directory {path}: {e}")
+                continue
+
+            known = dict(self._db.execute("SELECT path, mtime FROM files WHERE dir = ?", (path,)))
+            for file, file_mtime in files.items():
+                if known.get(file) == file_mtime:
+                    continue
+                if file in known:  # modified, send it as removed and added
+                    removed.append(os.path.relpath(file, root))
+                added.append([os.path.relpath(file, root), file_mtime])
+                self._db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (file, root, path, file_mtime))
+            for file in known.keys() - files.keys() - skipped:
+                removed.append(os.path.relpath(file, root))
+                self._db.execute("DELETE FROM files WHERE path = ?", (file,))
+
+            for (child,) in self._db.execute("SELECT path FROM dirs WHERE parent = ?", (path,)).fetchall():
+                if child not in subdirs and child not in skipped:
+                    self._remove_dir(child, root, removed)
+
+            if not skipped:
+                self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", (path, root, parent, mtime))
+            stack.extend((subdir, path) for subdir in subdirs)
+
+    def _remove_dir(self, path, root, removed):
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            for (file,) in self._db.execute("SELECT path FROM files WHERE dir = ?", (path,)):
+                removed.append(os.path.relpath(file, root))
+            stack.extend(child for (child,) in self._db.execute("SELECT path FROM dirs WHERE parent = ?", (path,)))
+            self._db.execute("DELETE FROM files WHERE dir = ?", (path,))
+            self._db.execute("DELETE FROM dirs WHERE path = ?", (path,))
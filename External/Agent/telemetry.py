@@ -0,0 +1,89 @@
+import os
+import time
+from array import array
+from collections import deque
+from datetime import datetime
+
+import psutil
+
+
+CPU_TEMP_FILE = "/sys/class/thermal/thermal_zone0/temp"
+FIELDS = ("cpu_temp", "cpu_usage", "mem_usage", "net_sent", "net_recv")  # sampled values, net - byte counters
+
+
+class TelemetryCollector:
+    # samples into a fixed-size ring (one array for all fields) and aggregates the samples of a window
+    def __init__(self, capacity, backlog):
+        self._capacity = capacity
+        self._samples = array("d", [0.0]) * (capacity * len(FIELDS))
+        self._times = array("d", [0.0]) * capacity
+        self._next = 0  # ring index of the next sample
+        self._window_count = 0  # samples since the last window
+        self._pending = deque(maxlen=backlog)  # not published windows
+        self._net_base = None  # (time, sent, received) of the previous window end
+        self._has_temp = os.path.isfile(CPU_TEMP_FILE)
+        psutil.cpu_percent()  # the first call is meaningless, it only starts the measurement
+
+    def sample(self):
+        offset = self._next * len(FIELDS)
+        self._samples[offset] = self._read_cpu_temp()
+        self._samples[offset + 1] = psutil.cpu_percent()
+        self._samples[offset + 2] = psutil.virtual_memory().percent
+        net = psutil.net_io_counters()
+        self._samples[offset + 3] = net.bytes_sent
+        self._samples[offset + 4] = net.bytes_recv
+        self._times[self._next] = time.time()
+
+        self._next = (self._next + 1) % self._capacity
+        self._window_count = min(self._window_count + 1, self._capacity)
+
+    def close_window(self):
+        # aggregate the samples since the last window and queue the result for publishing
+        if self._window_count == 0:
+            return None
+
+        indexes = [(self._next - i - 1) % self._capacity for i in reversed(range(self._window_count))]
+        self._window_count = 0
+        result = {"Time": datetime.fromtimestamp(self._times[indexes[-1]]).isoformat(timespec="seconds"),
+                  "samples": len(indexes)}
+        for i, field in enumerate(FIELDS[:3]):
+            if i == 0 and not self._has_temp:
+                continue
+            values = [self._samples[index * len(FIELDS) + i] for index in indexes]
+            result[field] = round(sum(values) / len(values), 2)
+            result[field + "_min"] = min(values)
+            result[field + "_max"] = max(values)
+
+        # counters are kept for compatibility, rates are bytes per second since the previous window
+        last = indexes[-1] * len(FIELDS)
+        net = (self._times[indexes[-1]], self._samples[last + 3], self._samples[last + 4])
+        base = self._net_base or (self._times[indexes[0]], self._samples[indexes[0] * len(FIELDS) + 3],
+                                  self._samples[indexes[0] * len(FIELDS) + 4])
+        self._net_base = net
+        for i, field in ((1, "net_sent"), (2, "net_recv")):
+            result[field] = int(net[i])
+            if net[0] > base[0]:
+                result[field + "_rate"] = round(max(net[i] - base[i], 0) / (net[0] - base[0]), 1)
+        result["disk_usage"] = {disk.mountpoint: psutil.disk_usage(disk.mountpoint).percent
+                                for disk in psutil.disk_partitions()}
+        self._pending.append(result)
+        return result
+
+    def publish(self, publish_func):
+        # publish the queued windows in order, stops on the first failure and keeps the rest for the next time
+        count = 0
+        while self._pending:
+            window = self._pending[0]
+            if window is not self._pending[-1]:
+                window["Replay"] = True  # late window, the receiver should use its time instead of the receive time
+            if not publish_func(window):
+                break
+            self._pending.popleft()
+            count += 1
+        return count
+
+    def _read_cpu_temp(self):
+        if not self._has_temp:
+            return 0.0
+        with open(CPU_TEMP_FILE) as file:
+            return int(file.read()) / 1000
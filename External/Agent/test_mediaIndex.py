@@ -0,0 +1,63 @@
+# python3 -m unittest discover -s External/Agent
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from mediaIndex import MediaIndex
+
+FORMATS = [".mp4", ".mkv"]
+
+
+class MediaIndexTest(unittest.TestCase):
+    def setUp(self):
+        self._temp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self._temp.name, "media")
+        os.makedirs(os.path.join(self.root, "movies"))
+        os.makedirs(os.path.join(self.root, "series", "s01"))
+        for file in ("movies/a.mp4", "series/s01/e01.mkv", "series/s01/notes.txt"):
+            open(os.path.join(self.root, file), "w").close()
+        self.index = MediaIndex(os.path.join(self._temp.name, "index.db"), FORMATS)
+
+    def tearDown(self):
+        self.index.close()
+        self._temp.cleanup()
+
+    def files(self):
+        return sorted(path for path, _ in self.index.snapshot([self.root])[self.root])
+
+    def test_scan(self):
+        changes = self.index.scan([self.root])
+        self.assertEqual(sorted(path for path, _ in changes[self.root]["added"]), ["movies/a.mp4", "series/s01/e01.mkv"])
+        self.assertEqual(self.index.scan([self.root]), {})
+
+    def test_symlink_loop(self):
+        os.symlink(self.root, os.path.join(self.root, "series", "loop"))
+        os.symlink("self.mp4", os.path.join(self.root, "series", "self.mp4"))  # stat fails with too many levels
+        self.index.scan([self.root])
+        self.assertEqual(self.files(), ["movies/a.mp4", "series/s01/e01.mkv"])
+
+    def test_unreadable_directory_keeps_its_files(self):
+        self.index.scan([self.root])
+        open(os.path.join(self.root, "series", "s01", "e02.mkv"), "w").close()
+        open(os.path.join(self.root, "movies", "b.mp4"), "w").close()
+
+        scandir = os.scandir
+        unreadable = os.path.join(self.root, "series", "s01")
+
+        def scandir_mock(path):
+            if path == unreadable:
+                raise PermissionError(13, "Permission denied", path)
+            return scandir(path)
+
+        with mock.patch("os.scandir", scandir_mock):
+            changes = self.index.scan([self.root], full=True)
+        self.assertEqual(changes[self.root], {"added": [["movies/b.mp4", mock.ANY]], "removed": []})
+        self.assertEqual(self.files(), ["movies/a.mp4", "movies/b.mp4", "series/s01/e01.mkv"])
+
+        changes = self.index.scan([self.root])  # readable again
+        self.assertEqual([path for path, _ in changes[self.root]["added"]], ["series/s01/e02.mkv"])
+
+
+if __name__ == "__main__":
+    unittest.main()
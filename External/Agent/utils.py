@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import subprocess
 from functools import wraps
@@ -14,6 +15,17 @@ except:
 
 def try_catch(defaultReturn=None, message=None):
     def wrapper(decorator):
+        if asyncio.iscoroutinefunction(decorator):
+            @wraps(decorator)
+            async def wrapped_async_decorator(*args, **kwargs):
+                try:
+                    return await decorator(*args, **kwargs)
+                except:
+                    logging.exception(
+                        message or "Failed to execute function: " + decorator.__name__)
+                    return defaultReturn
+            return wrapped_async_decorator
+
         @wraps(decorator)
         def wrapped_decorator(*args, **kwargs):
             try:
@@ -39,6 +51,15 @@ def init_media_player():
     return vlc.MediaPlayer()
 
 
+@try_catch()
+def attach_media_player_events(media_player, callback):
+    events = media_player.event_manager()
+    for event_type in (vlc.EventType.MediaPlayerPlaying, vlc.EventType.MediaPlayerPaused,
+                       vlc.EventType.MediaPlayerStopped, vlc.EventType.MediaPlayerEndReached,
+                       vlc.EventType.MediaPlayerEncounteredError, vlc.EventType.MediaPlayerAudioVolume):
+        events.event_attach(event_type, callback)
+
+
 @try_catch(None)
 def init_cec():
     cec.init()
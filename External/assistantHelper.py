@@ -1,74 +1,500 @@
 # python3 -m pip install -U onnxruntime==1.17.1
 
+import argparse
+import hashlib
 import io
+import os
 import sys
 import json
+import threading
+import time
 import numpy as np
-import base64
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, decode_audio
 import traceback
 from piper import PiperVoice
 import wave
+from collections import OrderedDict
+
+from helperProtocol import Channel, serve
+from helperStats import stats
 
 # tiny, tiny.en, base, base.en, small, small.en, distil-small.en, medium, medium.en, distil-medium.en, 
 # large-v1, large-v2, large-v3, large, distil-large-v2 or distil-large-v3
 # https://github.com/rhasspy/models/releases
 WHISPER_MODEL = "./models/small-int8/" 
 WHISPER_LANGUAGE = "bg"
+WHISPER_COMPUTE_TYPE = "int8"
+WHISPER_BEAM_SIZE = 2
+
+# adaptive decoding policy: short utterances (commands) - greedy and the fast model (if any),
+# longer ones - beam search with the accurate model, unless its recent real-time factor is too high
+SHORT_UTTERANCE = 3.0  # seconds
+MAX_RTF = 0.5  # decoding time / audio duration
+RTF_SMOOTHING = 0.3  # weight of the last request
+RTF_EXPIRY = 600  # seconds, older measurements are ignored, so the accurate decoding is tried again
 
 PIPER_MODEL = "./models/cs_CZ-jirka-medium.onnx"
 
-whisper = None
+TTS_CACHE_PATH = "./cache/tts"
+TTS_CACHE_MEMORY = 16 * 1024 * 1024  # bytes
+TTS_CACHE_DISK = 128 * 1024 * 1024  # bytes
+
+SAMPLE_RATE = 16000  # expected by whisper
+SAMPLE_FORMATS = {"u8": (np.dtype("u1"), 1 / 128.0, -128),  # dtype, scale, offset
+                  "s16le": (np.dtype("<i2"), 1 / 32768.0, 0),
+                  "s24le": (np.dtype("<i4"), 1 / 2147483648.0, 0),  # 3 bytes samples in the high bytes of int32
+                  "s32le": (np.dtype("<i4"), 1 / 2147483648.0, 0),
+                  "f32le": (np.dtype("<f4"), 1.0, 0)}
+
+# speech gate before whisper, on 20 ms frames
+GATE_FRAME = SAMPLE_RATE // 50
+GATE_MIN_DB = -50.0  # dBFS, quieter frames are silence
+GATE_SNR_DB = 10.0  # louder than the noise floor (10th percentile of the frames)
+GATE_MAX_NOISE_DB = -40.0  # dBFS, a louder floor is speech (clip voiced from start to end) or loud noise, e.g. TV or music
+GATE_MIN_RANGE_DB = 6.0  # with a louder floor the frames of speech vary as syllables (90th - 10th percentile), noise doesn't
+GATE_MAX_ZCR = 0.25  # zero-crossing rate, voiced frames are below it (noise and hiss are above)
+GATE_MIN_SPEECH = 0.2  # seconds of voiced frames
+GATE_PADDING = 0.3  # seconds kept before and after the voiced frames
+GATE_VAD_CHUNK = 512  # samples of the silero VAD model at 16 kHz
+GATE_VAD_CONTEXT = 64  # samples of the previous chunk before every chunk, expected by the v5 model
+GATE_VAD_THRESHOLD = 0.5
+
+whisperModels = {}  # name / model, the fast and the accurate models stay loaded
+whisperThreads = 0  # 0 - default of ctranslate2
+whisperWorkers = 1
+fastModel = None  # smaller model for short utterances, e.g. tiny
+decodingPolicy = "adaptive"
+rtfStats = {}  # (model, beam size) / (smoothed real-time factor, time, count)
+rtfLock = threading.Lock()
 piper = None
+vad = None
+gateEnabled = True
+vadModelPath = None
+modelsLock = threading.Lock()
+
+
+class AudioBuffer:
+    # reusable float32 buffers, so converting the audio doesn't allocate full-size copies for every request
+    def __init__(self):
+        self._samples = np.empty(0, np.float32)
+        self._resampled = np.empty(0, np.float32)
+
+    def convert(self, data, sample_rate=SAMPLE_RATE, sample_format="s16le", channels=1):
+        if sample_format == "file":  # not PCM (e.g. WAV with other codec), decoded by FFmpeg to 16 kHz mono
+            return decode_audio(io.BytesIO(data), sampling_rate=SAMPLE_RATE)
+
+        dtype, scale, offset = SAMPLE_FORMATS[sample_format]
+        if sample_format == "s24le":
+            packed = np.frombuffer(data, np.uint8, len(data) - len(data) % 3).reshape(-1, 3)
+            pcm = np.zeros(len(packed), dtype)
+            pcm.view(np.uint8).reshape(-1, 4)[:, 1:] = packed
+        else:
+            pcm = np.frombuffer(data, dtype, len(data) // dtype.itemsize)
+        if channels > 1:
+            pcm = pcm[:len(pcm) - len(pcm) % channels].reshape(-1, channels).mean(axis=1)
+
+        samples = self._ensure("_samples", len(pcm))
+        np.multiply(pcm, scale, out=samples, casting="unsafe")
+        if offset:
+            samples += offset * scale
+        if sample_rate == SAMPLE_RATE or len(samples) == 0:
+            return samples
+
+        # linear resampling to 16 kHz
+        count = int(len(samples) * SAMPLE_RATE / sample_rate)
+        resampled = self._ensure("_resampled", count)
+        resampled[:] = np.interp(np.arange(count) * (sample_rate / SAMPLE_RATE), np.arange(len(samples)), samples)
+        return resampled
+
+    def _ensure(self, name, size):
+        buffer = getattr(self, name)
+        if len(buffer) < size:
+            buffer = np.empty(max(size, len(buffer) * 2), np.float32)
+            setattr(self, name, buffer)
+        return buffer[:size]
+
+
+class SynthesisCache:
+    # synthesized WAVs by content hash, LRU in memory and on disk, so it survives restarts
+    def __init__(self, path, memory_limit, disk_limit):
+        self.path = path
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = OrderedDict()  # key / data
+        self._memory_size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(f"{PIPER_MODEL}\n{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        key = SynthesisCache.key(text)
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        filepath = os.path.join(self.path, key + ".wav")
+        try:
+            with open(filepath, "rb") as file:
+                data = file.read()
+            os.utime(filepath)  # mark as recently used
+        except OSError:
+            return None
+        self._put_memory(key, data)
+        return data
+
+    def put(self, text, data):
+        key = SynthesisCache.key(text)
+        self._put_memory(key, data)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            filepath = os.path.join(self.path, key + ".wav")
+            with open(filepath + ".tmp", "wb") as file:
+                file.write(data)
+            os.replace(filepath + ".tmp", filepath)
+            self._cleanup_disk()
+        except OSError:
+            sys.stderr.write(f"Failed to cache synthesized audio:\n{traceback.format_exc()}\n")
 
-def transcribe(data):
-    global whisper
-    if whisper is None:
-        whisper = WhisperModel(WHISPER_MODEL, device="cpu",
-                                compute_type="int8", download_root="./models")
+    def _put_memory(self, key, data):
+        with self._lock:
+            if key in self._memory:
+                self._memory_size -= len(self._memory.pop(key))
+            self._memory[key] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_limit and len(self._memory) > 1:
+                _, removed = self._memory.popitem(last=False)
+                self._memory_size -= len(removed)
 
-    audio_data = np.frombuffer(audio, np.int16).astype(np.float32) / 255.0
+    def _cleanup_disk(self):
+        files = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                 for entry in os.scandir(self.path) if entry.name.endswith(".wav")]
+        total = sum(size for _, size, _ in files)
+        if total < self.disk_limit:
+            return
+        for _, size, path in sorted(files):  # the least recently used first
+            os.remove(path)
+            total -= size
+            if total < self.disk_limit * 0.9:  # reach 90%
+                break
 
-    segments, _ = whisper.transcribe(audio_data,
-                                     language=WHISPER_LANGUAGE,
-                                     beam_size=2,
-                                     vad_filter=True,
-                                     vad_parameters=dict(min_silence_duration_ms=500))
 
-    return [(segment.start, segment.end, segment.text) for segment in segments]
+audioBuffers = threading.local()  # AudioBuffer per thread, requests can run in parallel
+ttsCache = SynthesisCache(TTS_CACHE_PATH, TTS_CACHE_MEMORY, TTS_CACHE_DISK)
 
-def synthesize(line):
+def load_whisper(name=None):
+    name = name or WHISPER_MODEL
+    with modelsLock:
+        if name not in whisperModels:
+            with stats.load(f"whisper {name}"):
+                whisperModels[name] = WhisperModel(name, device="cpu", compute_type=WHISPER_COMPUTE_TYPE,
+                                                   cpu_threads=whisperThreads, num_workers=whisperWorkers,
+                                                   download_root="./models")
+    return whisperModels[name]
+
+
+def load_vad():
+    # optional silero VAD (v5 onnx), None if it isn't configured
+    global vad
+    with modelsLock:
+        if vad is None and vadModelPath:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.inter_op_num_threads = options.intra_op_num_threads = 1
+            with stats.load("vad"):
+                vad = onnxruntime.InferenceSession(vadModelPath, options, providers=["CPUExecutionProvider"])
+    return vad
+
+
+def load_piper():
     global piper
-    if piper is None:
-        piper = PiperVoice.load(PIPER_MODEL, PIPER_MODEL + ".json")
-    
+    with modelsLock:
+        if piper is None:
+            with stats.load("piper"):
+                piper = PiperVoice.load(PIPER_MODEL, PIPER_MODEL + ".json")
+    return piper
+
+
+def warmup():
+    # load the models and run dummy inference, so the first real request doesn't wait for it
+    try:
+        start = time.time()
+        load_vad()
+        for model in {WHISPER_MODEL, fastModel or WHISPER_MODEL}:
+            list(transcribe_segments(np.zeros(16000, np.float32), model))
+        synthesize("1", use_cache=False)
+        return time.time() - start
+    except Exception:
+        sys.stderr.write(f"Failed to warm up:\n{traceback.format_exc()}\n")
+
+
+def transcribe_segments(audio_data, model=None, beam_size=None):
+    segments, _ = load_whisper(model).transcribe(audio_data,
+                                            language=WHISPER_LANGUAGE,
+                                            beam_size=beam_size or WHISPER_BEAM_SIZE,
+                                            vad_filter=True,
+                                            vad_parameters=dict(min_silence_duration_ms=500))
+    # segments is a generator, the decoding continues while iterating it
+    for segment in segments:
+        yield (segment.start, segment.end, segment.text)
+
+
+def speech_gate(audio_data):
+    # cheap check if there is speech at all and where, before the model is used
+    start_time = time.perf_counter()
+    frames = audio_data[:len(audio_data) - len(audio_data) % GATE_FRAME].reshape(-1, GATE_FRAME)
+    gate = {"speech": False, "duration": round(len(audio_data) / SAMPLE_RATE, 3), "start": 0.0, "end": 0.0,
+            "voiced": 0.0, "vad": None}
+    if len(frames) > 0:
+        energy = 10 * np.log10(np.einsum("ij,ij->i", frames, frames) / GATE_FRAME + 1e-10)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (GATE_FRAME - 1)
+        floor, peak = np.percentile(energy, (10, 90))
+        if floor <= GATE_MAX_NOISE_DB:
+            threshold = max(GATE_MIN_DB, floor + GATE_SNR_DB)
+        elif peak - floor >= GATE_MIN_RANGE_DB:  # voiced from start to end
+            threshold = GATE_MIN_DB
+        else:  # loud stationary noise
+            threshold = np.inf
+        voiced = np.flatnonzero((energy > threshold) & (zcr < GATE_MAX_ZCR))
+        gate["voiced"] = round(len(voiced) * GATE_FRAME / SAMPLE_RATE, 3)
+        if gate["voiced"] >= GATE_MIN_SPEECH:
+            padding = int(GATE_PADDING * SAMPLE_RATE)
+            start = max(0, int(voiced[0]) * GATE_FRAME - padding)
+            end = min(len(audio_data), (int(voiced[-1]) + 1) * GATE_FRAME + padding)
+            gate.update(speech=True, start=round(start / SAMPLE_RATE, 3), end=round(end / SAMPLE_RATE, 3))
+
+    if gate["speech"] and load_vad() is not None:
+        gate["vad"] = vad_probability(audio_data[int(gate["start"] * SAMPLE_RATE):int(gate["end"] * SAMPLE_RATE)])
+        gate["speech"] = gate["vad"] >= GATE_VAD_THRESHOLD
+    gate["time_ms"] = round((time.perf_counter() - start_time) * 1000, 3)
+    return gate
+
+
+def vad_probability(audio_data):
+    # max speech probability of the chunks, the model is recurrent, so the chunks go one by one
+    # with the tail of the previous chunk as context
+    chunks = audio_data[:len(audio_data) - len(audio_data) % GATE_VAD_CHUNK].reshape(-1, GATE_VAD_CHUNK)
+    state = np.zeros((2, 1, 128), np.float32)
+    context = np.zeros(GATE_VAD_CONTEXT, np.float32)
+    sample_rate = np.array(SAMPLE_RATE, np.int64)
+    result = 0.0
+    for chunk in chunks:
+        model_input = np.concatenate((context, chunk))[np.newaxis]
+        probability, state = vad.run(None, {"input": model_input, "state": state, "sr": sample_rate})
+        context = chunk[-GATE_VAD_CONTEXT:]
+        result = max(result, float(probability.item()))
+    return round(result, 3)
+
+
+def choose_decoding(duration):
+    # (model, beam size) for an utterance with the duration (seconds)
+    if decodingPolicy == "fixed":
+        return WHISPER_MODEL, WHISPER_BEAM_SIZE
+    if duration <= SHORT_UTTERANCE:
+        return fastModel or WHISPER_MODEL, 1
+
+    # step down while the recent decoding is slower than allowed
+    candidates = [(WHISPER_MODEL, WHISPER_BEAM_SIZE), (WHISPER_MODEL, 1)]
+    if fastModel:
+        candidates.append((fastModel, 1))
+    for candidate in candidates:
+        rtf = recent_rtf(*candidate)
+        if rtf is None or rtf <= MAX_RTF:
+            return candidate
+    return candidates[-1]
+
+
+def recent_rtf(model, beam_size):
+    with rtfLock:
+        window = rtfStats.get((model, beam_size))
+    return window[0] if window is not None and time.time() - window[1] < RTF_EXPIRY else None
+
+
+def update_rtf(model, beam_size, rtf):
+    with rtfLock:
+        previous = rtfStats.get((model, beam_size))
+        if previous is not None and time.time() - previous[1] < RTF_EXPIRY:
+            rtf = previous[0] + RTF_SMOOTHING * (rtf - previous[0])
+        rtfStats[(model, beam_size)] = (rtf, time.time(), (previous[2] if previous else 0) + 1)
+
+
+def rtf_info():
+    with rtfLock:
+        return {f"{model} beam {beam_size}": {"rtf": round(rtf, 3), "age": round(time.time() - updated), "count": count}
+                for (model, beam_size), (rtf, updated, count) in rtfStats.items()}
+
+
+def transcribe(data, sample_rate=SAMPLE_RATE, sample_format="s16le", channels=1):
+    return list(transcribe_stream(data, sample_rate, sample_format, channels)[0])
+
+
+def transcribe_stream(data, sample_rate=SAMPLE_RATE, sample_format="s16le", channels=1):
+    # returns the segments generator and the request info (speech gate, decoding, real-time factor),
+    # the info is complete after the generator is exhausted
+    if not hasattr(audioBuffers, "buffer"):
+        audioBuffers.buffer = AudioBuffer()
+    with stats.stage("convert"):
+        audio_data = audioBuffers.buffer.convert(data, sample_rate, sample_format, channels)
+    info = {"gate": None}
+    offset = 0.0
+    if gateEnabled:
+        with stats.stage("gate"):
+            info["gate"] = gate = speech_gate(audio_data)
+        if not gate["speech"]:
+            stats.count("gate_rejected")
+            return iter(()), info
+        offset = gate["start"]
+        audio_data = audio_data[int(offset * SAMPLE_RATE):int(gate["end"] * SAMPLE_RATE)]
+    return decode(audio_data, offset, info), info
+
+
+def decode(audio_data, offset, info):
+    duration = len(audio_data) / SAMPLE_RATE
+    model, beam_size = choose_decoding(duration)
+    info.update(model=model, beam_size=beam_size, audio=round(duration, 3))
+    start = time.perf_counter()
+    # the segments times are relative to the whole clip
+    for segment_start, segment_end, text in transcribe_segments(audio_data, model, beam_size):
+        yield segment_start + offset, segment_end + offset, text
+
+    elapsed = time.perf_counter() - start  # includes sending the segments
+    stats.record("decode", elapsed)
+    info.update(decode=round(elapsed, 3), rtf=round(elapsed / duration, 3) if duration > 0 else None)
+    if duration > 0:
+        update_rtf(model, beam_size, elapsed / duration)
+
+
+def parse_audio_args(args):
+    # [sampleRate] [format(u8/s16le/s24le/s32le/f32le/file)] [channels]
+    sample_rate = int(args[0]) if len(args) > 0 else SAMPLE_RATE
+    sample_format = args[1] if len(args) > 1 else "s16le"
+    channels = int(args[2]) if len(args) > 2 else 1
+    return sample_rate, sample_format, channels
+
+
+def synthesize(line, use_cache=True):
+    data = ttsCache.get(line) if use_cache else None
+    if data is not None:
+        stats.count("tts_cache_hits")
+        return data
+
+    piper = load_piper()
     buffer = io.BytesIO()
-    with wave.open(buffer, "wb") as wav_file:
+    with stats.stage("synthesize"), wave.open(buffer, "wb") as wav_file:
         piper.synthesize(line, wav_file)
+    data = buffer.getvalue()
+    if use_cache:
+        ttsCache.put(line, data)
+    return data
+
+
+def synthesize_stream(line):
+    # yield WAV for every sentence as soon as piper produces it
+    data = ttsCache.get(line)
+    if data is not None:
+        stats.count("tts_cache_hits")
+        yield data
+        return
+
+    piper = load_piper()
+    chunks = []
+    start = time.perf_counter()
+    for audio in piper.synthesize_stream_raw(line):
+        stats.record("synthesize", time.perf_counter() - start)  # per sentence
+        chunks.append(audio)
+        yield to_wav(audio, piper.config.sample_rate)
+        start = time.perf_counter()
+    ttsCache.put(line, to_wav(b"".join(chunks), piper.config.sample_rate))
+
+
+def to_wav(audio, sample_rate):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        wav_file.setframerate(sample_rate)
+        wav_file.setsampwidth(2)  # 16-bit
+        wav_file.setnchannels(1)  # mono
+        wav_file.writeframes(audio)
     return buffer.getvalue()
 
 
+def handle(request):
+    args = request.args
+    if request.command == "transcribe":
+        # transcribe [sampleRate] [format] [channels] \n <raw pcm audio>
+        res = json.dumps(transcribe(request.data[0], *parse_audio_args(args[1:])), ensure_ascii=False)
+        request.write(res.encode("utf-8"))
+
+    if request.command == "transcribeStream":
+        # transcribeStream [sampleRate] [format] [channels] \n <raw pcm audio>
+        # send every segment as soon as it's decoded, empty data at the end (+ the request info if pipelined)
+        info = None
+        try:
+            segments, info = transcribe_stream(request.data[0], *parse_audio_args(args[1:]))
+            for segment in segments:
+                request.write(json.dumps(segment, ensure_ascii=False).encode("utf-8"))
+        finally:
+            if request.channel.pipelined and info is not None:
+                request.write(b"", json.dumps(info).encode("utf-8"))
+            else:
+                request.write(b"")
+
+    if request.command == "rtf":  # rtf - recent real-time factor of the decoding configurations
+        request.write(json.dumps(rtf_info()))
+
+    if request.command == "synthesize":  # synthesize \n <text>
+        request.write(synthesize(request.data[0].decode("utf-8")))
+
+    if request.command == "synthesizeStream":  # synthesizeStream \n <text>
+        # send WAV for every sentence as soon as it's synthesized, empty data at the end
+        try:
+            for audio in synthesize_stream(request.data[0].decode("utf-8")):
+                request.write(audio)
+        finally:
+            request.write(b"")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--warmup", action="store_true", help="load the models on start")
+    parser.add_argument("--workers", type=int, default=2, help="parallel requests with the pipelined protocol")
+    parser.add_argument("--whisper-model", default=WHISPER_MODEL, help="model name (e.g. tiny) or path")
+    parser.add_argument("--piper-model", default=PIPER_MODEL, help="path of the .onnx model, its .json next to it")
+    parser.add_argument("--fast-model", help="smaller whisper model for short utterances, kept loaded with the main one")
+    parser.add_argument("--compute-type", default=WHISPER_COMPUTE_TYPE, help="e.g. int8, int8_float32, float32")
+    parser.add_argument("--beam-size", type=int, default=WHISPER_BEAM_SIZE, help="beam size of the accurate decoding")
+    parser.add_argument("--cpu-threads", type=int, default=whisperThreads, help="threads per decoding, 0 - default")
+    parser.add_argument("--num-workers", type=int, default=whisperWorkers, help="parallel decodings per model")
+    parser.add_argument("--policy", choices=["adaptive", "fixed"], default=decodingPolicy,
+                        help="adaptive - choose the model and beam by the utterance length and the recent real-time factor")
+    parser.add_argument("--short-utterance", type=float, default=SHORT_UTTERANCE, help="seconds, decoded greedy")
+    parser.add_argument("--max-rtf", type=float, default=MAX_RTF, help="real-time factor to step down the decoding")
+    parser.add_argument("--gate", action=argparse.BooleanOptionalAction, default=True,
+                        help="skip whisper for clips without speech and trim the silence")
+    parser.add_argument("--vad-model", help="silero VAD v5 .onnx model, used by the speech gate after the energy check")
+    options = parser.parse_args()
+    WHISPER_MODEL = options.whisper_model
+    WHISPER_COMPUTE_TYPE = options.compute_type
+    WHISPER_BEAM_SIZE = options.beam_size
+    PIPER_MODEL = options.piper_model
+    fastModel = options.fast_model
+    whisperThreads = options.cpu_threads
+    whisperWorkers = options.num_workers
+    decodingPolicy = options.policy
+    SHORT_UTTERANCE = options.short_utterance
+    MAX_RTF = options.max_rtf
+    gateEnabled = options.gate
+    vadModelPath = options.vad_model
+    stats.add_info("rtf", rtf_info)
+
     try:
-        for line in sys.stdin:
-            try:
-                if line.strip() == "transcribe":
-                    audio = base64.b64decode(sys.stdin.readline())
-                    res = json.dumps(transcribe(audio), ensure_ascii=False)
-                    print(base64.b64encode(res.encode('utf-8')))
-
-                if line.strip() == "synthesize":
-                    text = base64.b64decode(sys.stdin.readline()).decode("utf-8")
-                    audio = synthesize(text)
-                    print(base64.b64encode(audio))
-
-                if line.strip() == "exit":
-                    break
-
-                sys.stdout.flush()
-            except Exception:
-                sys.stderr.write(
-                    f"Failed to {line}:\n{traceback.format_exc()}\n")
+        if options.warmup:  # in background, so requests are accepted meanwhile
+            threading.Thread(target=warmup, daemon=True).start()
+
+        serve(Channel(), handle, {"transcribe": 1, "transcribeStream": 1,
+                                  "synthesize": 1, "synthesizeStream": 1}, options.workers,
+              ("transcribe", "transcribeStream", "rtf", "synthesize", "synthesizeStream"))
     finally:
         sys.stderr.write("Stop assistant helper\n")
-        
\ No newline at end of file
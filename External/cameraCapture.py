@@ -1,39 +1,616 @@
+import argparse
+import json
+import mmap
+import os
+import random
+import struct
 import sys
+import threading
 import time
+
+# quiet OpenCV and FFmpeg, their messages for unreachable cameras would fill the log on every reconnect
+os.environ.setdefault("OPENCV_LOG_LEVEL", "ERROR")
+os.environ.setdefault("OPENCV_FFMPEG_LOGLEVEL", "-8")  # AV_LOG_QUIET
 import cv2
 import numpy as np
-import base64
 from datetime import datetime, timedelta
 import traceback
 
-capture = cv2.VideoCapture()
-lastUse = datetime.now() + timedelta(minutes=-1)
+from collections import OrderedDict, deque
+
+from helperProtocol import Channel, serve
+from helperStats import stats
+
+MOTION_SIZE = (320, 240)
+MOTION_BLUR = (11, 11)
+MOTION_PIXEL_THRESHOLD = 25
+
+ENCODED_CACHE_SIZE = 4  # encoded images per camera
+# frame ring - header: magic, version, slots count, slot size, latest sequence
+# and slots count times: slot header (sequence, unix time, data length, result) + slot size bytes of JPEG data
+RING_HEADER = struct.Struct("<4sIIIQ")
+RING_SLOT_HEADER = struct.Struct("<QdII")
+RING_LATEST = struct.Struct("<Q")
+RING_LATEST_OFFSET = 16
+# without /dev/shm the ring would be written to the disk, the frames are pushed by subscribe instead
+RING_PATH = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+IMAGE_FORMATS = {"jpg": ".jpg", "jpeg": ".jpg", "webp": ".webp", "png": ".png"}
+
+# connections are opened in background, failed ones are retried with exponential backoff and jitter
+OPEN_TIMEOUT = 10000  # ms, open and read timeouts of the FFmpeg backend
+RETRY_DELAY = 1.0  # seconds, doubled after every failure
+RETRY_MAX_DELAY = 60.0
+MAIN_IDLE_TIMEOUT = 150.0  # seconds, the main stream of a camera with sub-stream is closed if not read meanwhile
+
+captures = {}  # address / CameraCapture
+capturesLock = threading.Lock()
+streams = {}  # (address, fps, size, quality) / FrameStream
+subscriptions = {}  # subscribe request id / FrameStream
+rings = {}  # (address, fps, size, quality) / FrameRing
+shares = {}  # share request id / (address, fps, size, quality)
+streamsLock = threading.Lock()
+grabEnabled = False
+encoder = None
+recordCodec = "mp4v"
+
+
+class FrameGrabber(threading.Thread):
+    # continuously read the capture and keep only the newest frame, so the stream buffer never gets stale
+    def __init__(self, capture):
+        super().__init__(daemon=True)
+        self.capture = capture
+        self.frame = None
+        self.timestamp = None
+        self.running = True
+        self._consumed = True
+        self._lock = threading.Lock()
+        self._first_frame = threading.Event()
+
+    def run(self):
+        while self.running:
+            res, img = self.capture.read()
+            if not res or img is None:
+                break
+            with self._lock:
+                if not self._consumed:
+                    stats.count("frames_dropped")
+                self.frame, self.timestamp = img, time.time()
+                self._consumed = False
+            self._first_frame.set()
+        self.running = False
+        self._first_frame.set()
+
+    def latest(self, timeout=1.0):
+        self._first_frame.wait(timeout)
+        with self._lock:
+            self._consumed = True
+            return self.frame, self.timestamp
+
+    def stop(self):
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(5)
+
+
+class OpenCvEncoder:
+    name = "opencv"
+
+    def encode(self, img, format="jpg", quality=95, optimize=False):
+        ext = IMAGE_FORMATS[format]
+        if ext == ".jpg":
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, int(optimize)]
+        elif ext == ".webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, 9 if optimize else 1]
+        return cv2.imencode(ext, img, params)[1].tobytes()
+
+
+class TurboJpegEncoder(OpenCvEncoder):
+    # libjpeg-turbo through PyTurboJPEG (python3 -m pip install PyTurboJPEG), other formats through OpenCV
+    name = "turbojpeg"
+
+    def __init__(self):
+        from turbojpeg import TurboJPEG, TJFLAG_FASTDCT
+        self.jpeg = TurboJPEG()
+        self.fast_flags = TJFLAG_FASTDCT
+
+    def encode(self, img, format="jpg", quality=95, optimize=False):
+        if IMAGE_FORMATS[format] != ".jpg":
+            return super().encode(img, format, quality, optimize)
+        return self.jpeg.encode(img, quality=quality, flags=0 if optimize else self.fast_flags)
+
+
+def create_encoder(name="auto"):
+    if name in ("auto", TurboJpegEncoder.name):
+        try:
+            return TurboJpegEncoder()
+        except Exception:  # the library or the native libturbojpeg is missing
+            if name != "auto":
+                raise
+    return OpenCvEncoder()
+
+
+class MotionDetector:
+    # keep downscaled, gray and blurred frames, so motion is scored without sending images around
+    def __init__(self, history=16, background_rate=0.05):
+        self.reference = None
+        self.background = None
+        self.background_rate = background_rate
+        self.history = deque(maxlen=history)  # (time, frame)
+
+    def score(self, img, threshold=0.0, background=False):
+        frame = preprocess(img)
+        self.history.append((time.time(), frame))
+        if self.background is None:
+            self.background = frame.astype(np.float32)
+        else:
+            cv2.accumulateWeighted(frame, self.background, self.background_rate)
+
+        if background:
+            result = diff_frames(frame, cv2.convertScaleAbs(self.background))
+        else:
+            result = diff_frames(frame, self.reference) if self.reference is not None else 1.0
+            # keep the reference until a movement is detected, so slow changes are accumulated
+            if result >= threshold:
+                self.reference = frame
+        return result
+
+    def score_history(self):
+        # score every frame from the history against the previous one with single vectorized call
+        if len(self.history) < 2:
+            return []
+        times = [t for t, _ in self.history]
+        frames = np.stack([f for _, f in self.history]).astype(np.int16)
+        changed = np.abs(np.diff(frames, axis=0)) > MOTION_PIXEL_THRESHOLD
+        scores = np.count_nonzero(changed, axis=(1, 2)) / (frames.shape[1] * frames.shape[2])
+        return list(zip(times[1:], scores.tolist()))
+
+    def reset(self):
+        self.reference = None
+        self.background = None
+        self.history.clear()
+
+
+class SegmentRecorder:
+    # append frames to a video segment rotated every hour, so archiving a day is only concatenation of segments
+    # (without re-encoding), all segments have the size of the first one
+    def __init__(self):
+        self.writer = None
+        self.hour = None
+        self.size = None
+
+    def write(self, img, path_prefix, fps):
+        hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+        if self.writer is not None and self.hour != hour:
+            self.close()
+
+        if self.writer is None:
+            os.makedirs(os.path.dirname(path_prefix) or ".", exist_ok=True)
+            filepath = f"{path_prefix}_{datetime.now():%Y-%m-%d_%H-%M}.mp4"
+            size = self.size or (img.shape[1], img.shape[0])
+            writer = cv2.VideoWriter(filepath, cv2.VideoWriter_fourcc(*recordCodec), fps, size)
+            if not writer.isOpened():
+                sys.stderr.write(f"Cannot open video writer for {filepath}\n")
+                return False
+            self.writer, self.hour, self.size = writer, hour, size
+
+        if (img.shape[1], img.shape[0]) != self.size:  # segment frames must have the same size
+            img = cv2.resize(img, self.size)
+        self.writer.write(img)
+        return True
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+class FrameStream(threading.Thread):
+    # push encoded frames at the target FPS to all subscribers, so viewers of the same camera share one stream
+    def __init__(self, key):
+        super().__init__(daemon=True)
+        self.key = key
+        self.address, self.fps, self.size, self.quality = key
+        self.subscribers = {}  # request id or ring path / Request or FrameRing
+
+    def run(self):
+        while True:
+            with streamsLock:
+                if not self.subscribers:
+                    streams.pop(self.key, None)
+                    break
+                subscribers = list(self.subscribers.values())
+
+            start = time.time()
+            with stats.command("stream"):
+                res, data = get_encoded_image(self.address, True, self.size, True, "jpg", self.quality)
+                for request in subscribers:
+                    request.write(res, data)
+            time.sleep(max(0.0, 1.0 / self.fps - (time.time() - start)))
+
+
+class FrameRing:
+    # JPEG frames in a memory-mapped file with N slots, so the host reads the latest frame without the pipe
+    def __init__(self, path, slots=4, slot_size=2 * 1024 * 1024):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.sequence = 0
+        self.users = set()  # share request ids
+        self._lock = threading.Lock()
+        self._file = open(path, "w+b")
+        self._file.truncate(RING_HEADER.size + slots * (RING_SLOT_HEADER.size + slot_size))
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        RING_HEADER.pack_into(self._map, 0, b"MHFR", 1, slots, slot_size, 0)
+
+    # the same signature as Request.write, so the ring can be a FrameStream subscriber
+    def write(self, *values):
+        if not values:
+            self.close()
+            return
+
+        result, data = values
+        with self._lock:
+            if self._map is None or len(data) > self.slot_size:  # closed or too big frame
+                return
+            self.sequence += 1
+            offset = RING_HEADER.size + (self.sequence % self.slots) * (RING_SLOT_HEADER.size + self.slot_size)
+            # zero sequence while writing, readers check it before and after copying the data
+            RING_SLOT_HEADER.pack_into(self._map, offset, 0, 0.0, 0, 0)
+            start = offset + RING_SLOT_HEADER.size
+            self._map[start:start + len(data)] = data
+            RING_SLOT_HEADER.pack_into(self._map, offset, self.sequence, time.time(), len(data), int(bool(result)))
+            RING_LATEST.pack_into(self._map, RING_LATEST_OFFSET, self.sequence)
+
+    def close(self):
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.close()
+            self._map = None
+            self._file.close()
+            os.remove(self.path)  # opened mappings stay valid
+
+    @staticmethod
+    def remove_stale():
+        # rings of killed capture processes stay in /dev/shm (RAM) until removed
+        if RING_PATH is None:
+            return
+        for name in os.listdir(RING_PATH):
+            parts = name.split("_")
+            if len(parts) != 4 or parts[:2] != ["myhome", "camera"] or not parts[2].isdigit():
+                continue
+            try:
+                os.kill(int(parts[2]), 0)
+                continue  # the process is alive
+            except PermissionError:  # alive, but of another user
+                continue
+            except OSError:
+                pass
+            try:
+                os.remove(os.path.join(RING_PATH, name))
+            except OSError:
+                pass
+
+
+class CameraCapture:
+    # one opened stream, commands for the same address are serialized, different addresses can run in parallel
+    # connection states: closed -> connecting -> open, failed -> connecting after the retry delay, any -> closed on release
+    # the state has its own lock, so it's answered while the capture is read or drained under the capture lock
+    def __init__(self, address):
+        self.address = address
+        self.capture = cv2.VideoCapture()
+        self.state = "closed"
+        self.failures = 0  # failed connections in a row
+        self.retry_time = 0.0  # monotonic time of the next connection attempt
+        self.grabber = None
+        self.motion = MotionDetector()
+        self.frame_time = None  # time of the last read frame
+        self.encoded = OrderedDict()  # (frame time, size, timestamp, encode params) / encoded image
+        self.recorder = SegmentRecorder()
+        self.lock = threading.RLock()
+        self._state_lock = threading.Lock()  # state, failures, retry time and connector
+        self.grab = None  # read in background, None - by the --grab option
+        self.sub = None  # low resolution stream of the same camera, CameraCapture
+        self.frame_size = None  # (width, height) of the last read frame
+        self.last_read = 0.0  # monotonic time
+        self._connector = None
+        self._stop = threading.Event()
+
+    def open(self):
+        # never blocks, returns if the capture is open now and starts connecting in background if it isn't
+        with self._state_lock:
+            if self.state != "open" and (self._connector is None or not self._connector.is_alive()):
+                self._stop.clear()
+                if self.state == "closed":
+                    self.state = "connecting"
+                self._connector = threading.Thread(target=self._connect, daemon=True,
+                                                   name=f"Camera connector {self.address}")
+                self._connector.start()
+            return self.state == "open"
+
+    def release(self):
+        self._stop.set()
+        with self.lock:
+            self._close()
+            with self._state_lock:
+                self.state = "closed"
+                self.failures = 0
+                self.retry_time = 0.0
+
+    def set_sub_stream(self, address):
+        # the sub-stream is always read in background, the main stream only when its frames are requested
+        with self.lock:
+            if self.sub is not None and self.sub.address == address:
+                return
+            if self.sub is not None:
+                self.sub.release()
+            self.sub = CameraCapture(address) if address else None
+            self.grab = False if self.sub is not None else None
+            if self.sub is not None:
+                self.sub.grab = True
+                self.sub.open()
+                if self.grabber is not None:  # the frames are read on request from now
+                    self.grabber.stop()
+                    self.grabber = None
+
+    def status(self):
+        with self._state_lock:
+            return {"state": self.state, "failures": self.failures,
+                    "retry_in": round(max(0.0, self.retry_time - time.monotonic()), 1) if self.state == "failed" else 0.0}
+
+    # copy=False returns the frame shared with next requests, so it must not be modified
+    def read(self, copy=True):
+        if not self.open():  # don't wait for the capture lock if there is nothing to read
+            return False, None
+        with self.lock:
+            if self.state != "open":  # lost while waiting for the lock
+                return False, None
+            self._start_grabber()
+            self.last_read = time.monotonic()
+            with stats.stage("read"):
+                if self.grabber is None:
+                    result, img = self.capture.read()
+                    self.frame_time = time.time()
+                else:
+                    img, self.frame_time = self.grabber.latest()
+                    result = img is not None and self.grabber.running
+                    img = (img.copy() if copy else img) if result else None
+
+            if img is None:
+                self._close()  # the connection is lost, connect again in background
+                self._failed()
+            else:
+                self.frame_size = (img.shape[1], img.shape[0])
+            return result, img
+
+    def drop_old_frames(self):
+        if not self.open():
+            return 0
+        with self.lock:
+            self._start_grabber()
+            # the background grabber always keeps only the newest frame
+            if self.state != "open" or self.grabber is not None:
+                return 0
+
+            timeout_timer = datetime.now()
+            timer = datetime.now()
+            # drop frames until it took less than 100 ms for a frame (not buffered) or timeout - 3 sec
+            i = 0
+            while datetime.now() - timer < timedelta(milliseconds=100) and datetime.now() - timeout_timer < timedelta(seconds=3):
+                timer = datetime.now()
+                res, _ = self.capture.read()
+                i += 1
+                if not res:
+                    break
+            stats.count("frames_dropped", i)
+            return i
+
+    def _connect(self):
+        # connector thread, the capture lock isn't held while opening, so the commands answer meanwhile
+        while not self._stop.is_set():
+            with self._state_lock:
+                delay = self.retry_time - time.monotonic()
+                self.state = "connecting" if delay <= 0 else "failed"
+            if delay > 0:
+                self._stop.wait(delay)
+                continue
+
+            with stats.command("connect"):
+                capture = open_capture(self.address)
+                opened, img = capture.read() if capture.isOpened() else (False, None)  # read one image to prepare the capture
+            with self.lock:
+                if self._stop.is_set():  # released meanwhile
+                    capture.release()
+                    return
+                if opened:
+                    self._close()
+                    self.capture = capture
+                    self.frame_size = (img.shape[1], img.shape[0])
+                    with self._state_lock:
+                        self.state = "open"
+                        self.failures = 0
+                    self._start_grabber()
+                    return
+                capture.release()
+                self._failed()
+
+    def _start_grabber(self):
+        # call with the capture lock
+        grab = grabEnabled if self.grab is None else self.grab
+        if self.state == "open" and grab and (self.grabber is None or not self.grabber.is_alive()):
+            self.grabber = FrameGrabber(self.capture)
+            self.grabber.start()
+
+    def _failed(self):
+        with self._state_lock:
+            self.state = "failed"
+            self.failures += 1
+            delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** (self.failures - 1))
+            self.retry_time = time.monotonic() + delay * random.uniform(0.5, 1.0)
+
+    def _close(self):
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber = None
+        if self.capture.isOpened():
+            self.capture.release()
+
+
+def open_capture(address):
+    if address.isnumeric():  # local device
+        return cv2.VideoCapture(int(address))
+    if hasattr(cv2, "CAP_PROP_OPEN_TIMEOUT_MSEC"):  # OpenCV 4.5.2+
+        return cv2.VideoCapture(address, cv2.CAP_FFMPEG, [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, OPEN_TIMEOUT,
+                                                          cv2.CAP_PROP_READ_TIMEOUT_MSEC, OPEN_TIMEOUT])
+    return cv2.VideoCapture(address)
 
 
 def get_capture(address):
-    global capture, lastUse
-    if not capture.isOpened() and datetime.now() - lastUse > timedelta(minutes=1):
-        capture.open(int(address) if address.isnumeric() else address)
-        if capture.isOpened():
-            capture.read()  # dump one image to prepare the capture
+    with capturesLock:
+        if address not in captures:
+            captures[address] = CameraCapture(address)
+        return captures[address]
+
+
+def release_capture(address=None):
+    with capturesLock:
+        if address is None:
+            released = list(captures.values())
+            captures.clear()
+        else:
+            released = [captures.pop(address)] if address in captures else []
+    for capture in released:
+        with capture.lock:
+            capture.release()
+            capture.recorder.close()
+            if capture.sub is not None:
+                capture.sub.release()
 
-        lastUse = datetime.now()
 
-    if capture.isOpened():
-        lastUse = datetime.now()
+def select_capture(capture, size=None, full=True):
+    # frames which fit in the sub-stream are read from it, so the main stream is decoded only for full resolution,
+    # full resolution is from the sub-stream too while the main stream connects
+    sub = capture.sub
+    if sub is None or not sub.open():
+        return capture
+    if full and (size is None or sub.frame_size is None or size[0] > sub.frame_size[0] or size[1] > sub.frame_size[1]):
+        if capture.open():
+            return capture
+        return sub
 
-    return capture
+    if capture.state == "open" and time.monotonic() - capture.last_read > MAIN_IDLE_TIMEOUT \
+            and capture.lock.acquire(blocking=False):  # not if it's read meanwhile
+        try:
+            capture.release()  # reopened on the next full resolution request
+        finally:
+            capture.lock.release()
+    return sub
+
+
+def captures_info():
+    with capturesLock:
+        items = list(captures.items())
+    return {address: dict(capture.status(), frame_size=capture.frame_size,
+                          sub=capture.sub.address if capture.sub is not None else None) for address, capture in items}
 
 
 def get_image(address, initIfEmpty=True, size=None, timestamp=True):
-    global lastUse
+    capture = select_capture(get_capture(address), size)
+    with capture.lock:
+        result, img = capture.read(copy=False)
+        frame_time = capture.frame_time
+    return draw_image(result, img, initIfEmpty, size, timestamp, frame_time)
+
+
+def get_encoded_image(address, initIfEmpty=True, size=None, timestamp=True, format="jpg", quality=95, optimize=False):
+    # viewers asking for the same frame share a single encode
+    capture = select_capture(get_capture(address), size)
+    with capture.lock:
+        result, img = capture.read(copy=False)
+        key = (capture.frame_time, size, timestamp, format, quality, optimize)
+        if img is not None and key in capture.encoded:
+            stats.count("encode_cache_hits")
+            return result, capture.encoded[key]
+
+        img = draw_image(result, img, initIfEmpty, size, timestamp, capture.frame_time)[1]
+        with stats.stage("encode"):
+            data = encoder.encode(img, format, quality, optimize) if img is not None else b""
+        if result and img is not None:
+            capture.encoded[key] = data
+            while len(capture.encoded) > ENCODED_CACHE_SIZE:
+                capture.encoded.popitem(last=False)
+        return result, data
+
+
+def record_image(address, path_prefix, fps=1.0):
+    # always from the main stream, never from the sub-stream
     capture = get_capture(address)
-    result, img = capture.read()
-    if img is None:  # add empty image with red X
-        if capture.isOpened():
-            capture.release()  # try to release the camera and open it again next time
-        lastUse = datetime.now() - timedelta(minutes=1)
+    with capture.lock:
+        result, img = capture.read(copy=False)
+        if img is None:
+            return False
+        img = draw_image(result, img, False, None, True, capture.frame_time)[1]
+        with stats.stage("write video"):
+            return capture.recorder.write(img, path_prefix, fps)
+
+
+def get_stream(key):
+    # call with streamsLock
+    stream = streams.get(key)
+    if stream is None:
+        stream = streams[key] = FrameStream(key)
+        stream.start()
+    return stream
+
+
+def subscribe(request, address, fps=20.0, size=None, quality=80):
+    with streamsLock:
+        stream = get_stream((address, fps, size, quality))
+        stream.subscribers[request.id] = request
+        subscriptions[request.id] = stream
+
+
+def share(request, address, fps=20.0, size=None, quality=80):
+    # all share requests with the same parameters use the same ring, empty path if it cannot be created
+    if RING_PATH is None:
+        return ""
+    with streamsLock:
+        key = (address, fps, size, quality)
+        ring = rings.get(key)
+        if ring is None:
+            try:
+                ring = FrameRing(os.path.join(RING_PATH, f"myhome_camera_{os.getpid()}_{request.id}"))
+            except OSError:  # e.g. full /dev/shm
+                return ""
+            rings[key] = ring
+            get_stream(key).subscribers[ring.path] = ring
+        ring.users.add(request.id)
+        shares[request.id] = key
+        return ring.path
+
 
+def unsubscribe(request_id):
+    with streamsLock:
+        if request_id in shares:
+            key = shares.pop(request_id)
+            ring = rings[key]
+            ring.users.discard(request_id)
+            if ring.users:
+                return
+            del rings[key]
+            subscriber = streams[key].subscribers.pop(ring.path, None) if key in streams else ring
+        else:
+            stream = subscriptions.pop(request_id, None)
+            subscriber = stream.subscribers.pop(request_id, None) if stream is not None else None
+    if subscriber is not None:
+        subscriber.write()  # end of the stream
+
+
+def draw_image(result, img, initIfEmpty=True, size=None, timestamp=True, frame_time=None):
+    if img is None:  # add empty image with red X
         if not initIfEmpty:
             return result, None
         img = np.zeros((480, 640, 3), np.uint8)
@@ -42,89 +619,174 @@ def get_image(address, initIfEmpty=True, size=None, timestamp=True):
     else:
         result = True
     if size is not None:
-        img = cv2.resize(img, size)
+        with stats.stage("resize"):
+            img = cv2.resize(img, size)
+    elif timestamp and result:
+        img = img.copy()  # don't draw over the shared frame
     if timestamp:
-        scale = img.shape[0] / 800  # height / 800
-        text = time.strftime("%d/%m/%Y %H:%M:%S")
-        textSize, _ = cv2.getTextSize(
-            text, cv2.FONT_HERSHEY_SIMPLEX, scale, round(scale * 3))
-        cv2.putText(img, text, (5, 5 + textSize[1]), cv2.FONT_HERSHEY_SIMPLEX,
-                    scale, (255, 255, 255), round(scale * 3), cv2.FILLED)
+        with stats.stage("timestamp"):
+            scale = img.shape[0] / 800  # height / 800
+            text = time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(frame_time))
+            textSize, _ = cv2.getTextSize(
+                text, cv2.FONT_HERSHEY_SIMPLEX, scale, round(scale * 3))
+            cv2.putText(img, text, (5, 5 + textSize[1]), cv2.FONT_HERSHEY_SIMPLEX,
+                        scale, (255, 255, 255), round(scale * 3), cv2.FILLED)
     return result, img
 
 
 def drop_old_frames(address):
+    return get_capture(address).drop_old_frames()
+
+
+def detect_motion(address, threshold=0.0, background=False):
     capture = get_capture(address)
-    # if capture is not open or we use it less than 1 seconds ago
-    if not capture.isOpened():
-        print(0)
-        return
-
-    timeout_timer = datetime.now()
-    timer = datetime.now()
-    # drop frames until it took less than 100 ms for a frame (not buffered) or timeout - 3 sec
-    i = 0
-    while datetime.now() - timer < timedelta(milliseconds=100) and datetime.now() - timeout_timer < timedelta(seconds=3):
-        timer = datetime.now()
-        res, _ = capture.read()
-        i += 1
-        if not res:
-            break
-    return i
+    source = select_capture(capture, full=False)
+    with source.lock:
+        result, img = source.read()
+    if img is None:
+        return -1.0
+    with capture.lock, stats.stage("motion"):
+        return capture.motion.score(img, threshold, background)
+
+
+def preprocess(img):
+    img = cv2.resize(img, MOTION_SIZE, interpolation=cv2.INTER_AREA)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.GaussianBlur(img, MOTION_BLUR, 0)
+
+
+def diff_frames(frame1, frame2):
+    diff = cv2.absdiff(frame1, frame2)
+    _, diff = cv2.threshold(diff, MOTION_PIXEL_THRESHOLD, 255, cv2.THRESH_BINARY)
+    return cv2.countNonZero(diff) / (diff.shape[0] * diff.shape[1])
 
 
 def diff_images(img1, img2):
-    img1 = cv2.resize(img1, (640, 480))
-    img1 = cv2.cvtColor(img1, cv2.COLOR_BGR2GRAY)
-    img1 = cv2.GaussianBlur(img1, (21, 21), 0)
+    return diff_frames(preprocess(img1), preprocess(img2))
+
+
+def handle(request):
+    args = request.args
+    if request.command == "isOpened":  # isOpened <address>
+        request.write(get_capture(args[1]).open())
+
+    if request.command == "connectionState":  # connectionState <address>
+        request.write(json.dumps(get_capture(args[1]).status()))
+
+    if request.command == "getImage":
+        # getImage <address> [initIfEmpty(True/False)] [width,height] [timestamp(True/False)]
+        #   [format(jpg/webp/png)] [quality(0-100)] [optimize(True/False)]
+        initIfEmpty = args[2].lower() == "true" if len(args) > 2 else True
+        size = (int(args[3].split(",")[0]), int(args[3].split(",")[1])) if len(args) > 3 and args[3] != "None" else None
+        timestamp = args[4].lower() == "true" if len(args) > 4 else True
+        format = args[5].lower() if len(args) > 5 and args[5].lower() in IMAGE_FORMATS else "jpg"  # unknown as jpg
+        quality = int(args[6]) if len(args) > 6 else 95
+        optimize = args[7].lower() == "true" if len(args) > 7 else False
+        request.write(*get_encoded_image(args[1], initIfEmpty, size, timestamp, format, quality, optimize))
+
+    if request.command == "record":  # record <address> [fps] \n <path prefix of the segments>
+        fps = float(args[2]) if len(args) > 2 else 1.0
+        request.write(record_image(args[1], request.data[0].decode("utf-8"), fps))
 
-    img2 = cv2.resize(img2, (640, 480))
-    img2 = cv2.cvtColor(img2, cv2.COLOR_BGR2GRAY)
-    img2 = cv2.GaussianBlur(img2, (21, 21), 0)
+    if request.command == "recordClose":  # recordClose <address>
+        capture = get_capture(args[1])
+        with capture.lock:
+            capture.recorder.close()
+        request.write(True)
 
-    diff = cv2.absdiff(img1, img2)
-    _, diff = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)
-    return cv2.countNonZero(diff) / (640 * 480)
+    if request.command == "dropOldFrames":  # dropOldFrames <address>
+        request.write(drop_old_frames(args[1]))
+
+    if request.command == "subscribe":
+        # subscribe <address> [fps] [width,height] [quality(0-100)]
+        # push (result, image) with the request id until unsubscribe, empty message at the end
+        # used instead of share when the frame ring isn't available
+        if not request.channel.pipelined:  # the responses would block the other requests
+            request.write(False, b"")
+            return
+        fps = float(args[2]) if len(args) > 2 else 20.0
+        size = (int(args[3].split(",")[0]), int(args[3].split(",")[1])) if len(args) > 3 and args[3] != "None" else None
+        quality = int(args[4]) if len(args) > 4 else 80
+        request.deferred = True
+        subscribe(request, args[1], fps, size, quality)
+
+    if request.command == "share":
+        # share <address> [fps] [width,height] [quality(0-100)]
+        # write frames to a memory-mapped ring until unsubscribe, responds with the ring file path (empty if not available)
+        if not request.channel.pipelined:  # unsubscribe needs the request id
+            request.write("")
+            return
+        fps = float(args[2]) if len(args) > 2 else 20.0
+        size = (int(args[3].split(",")[0]), int(args[3].split(",")[1])) if len(args) > 3 and args[3] != "None" else None
+        quality = int(args[4]) if len(args) > 4 else 80
+        request.write(share(request, args[1], fps, size, quality))
+
+    if request.command == "unsubscribe":  # unsubscribe <subscribe or share request id>
+        unsubscribe(int(args[1]))
+
+    if request.command == "release":  # release <address>
+        release_capture(args[1])
+
+    if request.command == "subStream":  # subStream <address> [sub-stream address], without it the sub-stream is removed
+        get_capture(args[1]).set_sub_stream(args[2] if len(args) > 2 else None)
+
+    if request.command == "diffImages":  # diffImages \n <img1> \n <img2>
+        np_img1 = np.frombuffer(request.data[0], dtype=np.uint8)
+        np_img2 = np.frombuffer(request.data[1], dtype=np.uint8)
+        with stats.stage("decode"):
+            img1, img2 = cv2.imdecode(np_img1, flags=1), cv2.imdecode(np_img2, flags=1)
+        with stats.stage("diff"):
+            diff = diff_images(img1, img2)
+        request.write(diff)
+
+    if request.command == "motion":
+        # motion <address> [threshold] [background(True/False)]
+        threshold = float(args[2]) if len(args) > 2 else 0.0
+        background = args[3].lower() == "true" if len(args) > 3 else False
+        request.write(detect_motion(args[1], threshold, background))
+
+    if request.command == "motionHistory":  # motionHistory <address>
+        capture = get_capture(args[1])
+        with capture.lock:  # the history is updated by the motion requests
+            history = capture.motion.score_history()
+        request.write(json.dumps(history))
+
+    if request.command == "motionReset":  # motionReset <address>
+        capture = get_capture(args[1])
+        with capture.lock:
+            capture.motion.reset()
 
 
 if __name__ == "__main__":
-    try:
-        for line in sys.stdin:
-            try:
-                if line.startswith("isOpened"):
-                    args = line.split()  # isOpened <address>
-                    print(get_capture(args[1]).isOpened())
-
-                if line.startswith("getImage"):
-                    # getImage <address> [initIfEmpty(True/False)] [width,height] [timestamp(True/False)]
-                    args = line.split()
-                    initIfEmpty = args[2].lower() == "true" if len(args) > 2 else True
-                    size = (int(args[3].split(",")[0]), int(args[3].split(",")[1])) if len(args) > 3 and args[3] != "None" else None
-                    timestamp = args[4].lower() == "true" if len(args) > 4 else True
-                    res, img = get_image(args[1], initIfEmpty, size, timestamp)
-                    print(res)
-                    print(base64.b64encode(cv2.imencode(".jpg", img)[1]))
-
-                if line.startswith("dropOldFrames"):
-                    args = line.split()  # dropOldFrames <address>
-                    res = drop_old_frames(args[1])
-                    print(res)
-
-                if line.strip() == "diffImages": # diffImages \n <img1> \n <img2>
-                    img1 = base64.b64decode(sys.stdin.readline())
-                    np_img1 = np.frombuffer(img1, dtype=np.uint8)
-                    img2 = base64.b64decode(sys.stdin.readline())
-                    np_img2 = np.frombuffer(img1, dtype=np.uint8)
-                    diff = diff_images(cv2.imdecode(np_img1, flags=1),
-                                       cv2.imdecode(np_img2, flags=1))
-                    print(diff)
-                    
-                if line.strip() == "exit":
-                    break
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grab", action="store_true", help="read frames continuously in a background thread")
+    parser.add_argument("--workers", type=int, default=4, help="parallel requests with the pipelined protocol")
+    parser.add_argument("--encoder", choices=["auto", "opencv", "turbojpeg"], default="auto",
+                        help="image encoder, auto uses turbojpeg if it's installed")
+    parser.add_argument("--record-codec", default=recordCodec,
+                        help="fourcc of the recorded segments, e.g. avc1 if OpenCV is built with H.264 encoder")
+    parser.add_argument("--open-timeout", type=int, default=OPEN_TIMEOUT,
+                        help="milliseconds to wait for a network stream to open or send a frame")
+    options = parser.parse_args()
+    grabEnabled = options.grab
+    OPEN_TIMEOUT = options.open_timeout
+    encoder = create_encoder(options.encoder)
+    recordCodec = options.record_codec
+    stats.add_info("captures", captures_info)
+    FrameRing.remove_stale()
 
-                sys.stdout.flush()
-            except Exception:
-                sys.stderr.write(f"Failed to execute camera command {line}:\n{traceback.format_exc()}\n")
+    try:
+        serve(Channel(), handle, {"diffImages": 2, "record": 1}, options.workers,
+              ("isOpened", "connectionState", "getImage", "record", "recordClose", "dropOldFrames", "subscribe", "share",
+               "unsubscribe", "release", "subStream", "diffImages", "motion", "motionHistory", "motionReset"))
     finally:
-        capture.release()
+        with streamsLock:
+            stopped = list(streams.values())
+            for stream in stopped:
+                stream.subscribers.clear()
+        for stream in stopped:
+            stream.join(1)
+        for ring in list(rings.values()):
+            ring.close()
+        release_capture()
         sys.stderr.write("Close camera\n")
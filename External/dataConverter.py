@@ -1,45 +1,120 @@
+import argparse
 import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-if __name__ == "__main__":
-	with open("data-old.json", "r", encoding="utf8") as file:
-		data = json.load(file)
+try:
+	import ijson  # incremental parsing, optional
+except ImportError:
+	ijson = None
 
-	data = data["Sensors"]
-	print(data.keys())
-	
-	with open("data-new.json", "r", encoding="utf8") as file:
-		newData = json.load(file)
+DEVICES_PLACEHOLDER = "$devices$"
+
+
+def read_sensors(file):
+	# (name, sensor) one by one, without ijson the whole file is loaded
+	if ijson is not None:
+		yield from ijson.kvitems(file, "Sensors", use_float=True)
+	else:
+		print("ijson isn't installed, the whole file is loaded in memory", file=sys.stderr)
+		yield from json.load(file)["Sensors"].items()
+
+
+def convert_sensor(name, sensor, startId, indent):
+	# create Device, returns its json with the given indentation of every line after the first
+	device = {}
+	device["$id"] = startId
+	startId += 1
+	device["$type"] = "MyHome.Systems.Devices.MySensor, MyHome"
+	device["Address"] = ""
+	device["Token"] = sensor[2]["token"][2]
 
-	startId = 6
-	devices = newData["Systems"]["DevicesSystem"]["Devices"]["$values"]
-	for name, sensor in data.items():
-		# create Devices
-		device = {}
-		device["$id"] = startId
+	device["Data"] = {}
+	device["Data"]["$type"] = "System.Collections.Generic.Dictionary`2[[System.DateTime, System.Private.CoreLib],[MyHome.Systems.Devices.BaseSensor+SensorValue, MyHome]], System.Private.CoreLib";
+	for time, item in sensor[2]["data"][2].items():
+		tTime = time.replace(" ", "T")
+		device["Data"][tTime] = {}
+		device["Data"][tTime]["$id"] = startId
 		startId += 1
-		device["$type"] = "MyHome.Systems.Devices.MySensor, MyHome"
-		device["Address"] = ""
-		device["Token"] = sensor[2]["token"][2]
-
-		device["Data"] = {}
-		device["Data"]["$type"] = "System.Collections.Generic.Dictionary`2[[System.DateTime, System.Private.CoreLib],[MyHome.Systems.Devices.BaseSensor+SensorValue, MyHome]], System.Private.CoreLib";
-		for time, item in sensor[2]["data"][2].items():
-			tTime = time.replace(" ", "T")
-			device["Data"][tTime] = {}
-			device["Data"][tTime]["$id"] = startId
-			startId += 1
-			device["Data"][tTime]["$type"] = "MyHome.Systems.Devices.BaseSensor+SensorValue, MyHome"
-			for subType, value in item[2].items():
-				if value[2]  in ("False", "True"):
-					device["Data"][tTime][subType] = 1.0 if value[2] == "True" else 0.0
-				else:
-					device["Data"][tTime][subType] = round(float(value[2]), 2)
-
-		device["Owner"] = {"$ref": "3"}
-		device["Name"] = name
-		device["Room"] = {"$ref": "2"}
-
-		devices.append(device)
-
-	with open("data.json", "w", encoding="utf8") as file:
-		file.write(json.dumps(newData, indent=2, ensure_ascii=True))
\ No newline at end of file
+		device["Data"][tTime]["$type"] = "MyHome.Systems.Devices.BaseSensor+SensorValue, MyHome"
+		for subType, value in item[2].items():
+			if value[2]  in ("False", "True"):
+				device["Data"][tTime][subType] = 1.0 if value[2] == "True" else 0.0
+			else:
+				device["Data"][tTime][subType] = round(float(value[2]), 2)
+
+	device["Owner"] = {"$ref": "3"}
+	device["Name"] = name
+	device["Room"] = {"$ref": "2"}
+
+	return json.dumps(device, indent=2, ensure_ascii=True).replace("\n", "\n" + indent)
+
+
+def write_devices(file, devices, newData):
+	# stream newData, the converted devices are written in place of the placeholder at the end of the devices list
+	placeholder = json.dumps(DEVICES_PLACEHOLDER)
+	newData["Systems"]["DevicesSystem"]["Devices"]["$values"].append(DEVICES_PLACEHOLDER)
+	for chunk in json.JSONEncoder(indent=2, ensure_ascii=True).iterencode(newData):
+		if not chunk.endswith(placeholder):
+			file.write(chunk)
+			continue
+
+		# chunk is separator + indentation + placeholder
+		prefix = chunk[:-len(placeholder)]
+		indent = prefix[prefix.rfind("\n") + 1:]
+		first = True
+		for device in devices(indent):
+			file.write((prefix if first else ",\n" + indent) + device)
+			first = False
+		if first:  # no devices, keep the list opening bracket if the placeholder is the first item
+			file.write(prefix[:prefix.find("\n")].rstrip(","))
+
+
+def convert(oldPath, newPath, outputPath, startId, workers):
+	with open(newPath, "r", encoding="utf8") as file:
+		newData = json.load(file)
+
+	start = time.time()
+
+	def devices(indent):
+		# convert the sensors in parallel, keeping only a few in memory, the order is preserved
+		nonlocal startId
+		with open(oldPath, "rb") as file, ProcessPoolExecutor(workers) as executor:
+			fileSize = file.seek(0, 2)
+			file.seek(0)
+			pending = deque()
+			count = 0
+			for name, sensor in read_sensors(file):
+				samples = len(sensor[2]["data"][2])
+				pending.append((name, samples, executor.submit(convert_sensor, name, sensor, startId, indent)))
+				startId += 1 + samples
+				del sensor
+				while len(pending) > workers * 2 or (pending and pending[0][2].done()):
+					name, samples, future = pending.popleft()
+					count += 1
+					print(f"[{count}] {name}: {samples} samples, {file.tell() * 100 // max(fileSize, 1)}% read, "
+						  f"{time.time() - start:.1f} sec", file=sys.stderr)
+					yield future.result()
+			while pending:
+				name, samples, future = pending.popleft()
+				count += 1
+				print(f"[{count}] {name}: {samples} samples, {time.time() - start:.1f} sec", file=sys.stderr)
+				yield future.result()
+
+	with open(outputPath, "w", encoding="utf8") as file:
+		write_devices(file, devices, newData)
+	print(f"Done in {time.time() - start:.1f} sec", file=sys.stderr)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Migrate the old sensors data to the new data file")
+	parser.add_argument("--old", default="data-old.json")
+	parser.add_argument("--new", default="data-new.json")
+	parser.add_argument("--output", default="data.json")
+	parser.add_argument("--start-id", type=int, default=6)
+	parser.add_argument("--workers", type=int, default=2, help="processes converting sensors in parallel")
+	args = parser.parse_args()
+
+	convert(args.old, args.new, args.output, args.start_id, args.workers)
@@ -0,0 +1,399 @@
+import argparse
+import base64
+import json
+import math
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from helperProtocol import FRAME_HEADER, MESSAGE_HEADER
+
+# Load test of the helper processes through their stdin/stdout protocol (helperProtocol.py), with local stand-ins
+# for the cameras (generated video files) and the microphone (generated or given PCM audio).
+# Results are printed and written as JSON, so runs of different commits can be compared (--compare).
+
+
+class HelperClient:
+    # helper subprocess driven like HelperProcess.cs does, parallel requests need protocol 3
+    # timeout - seconds to wait for a response, a helper without the pipelined protocol is killed after it
+    def __init__(self, script, args, protocol, timeout=60.0):
+        self.process = subprocess.Popen([sys.executable, script] + args, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        cwd=os.path.dirname(os.path.abspath(script)))
+        self.stderr = []
+        threading.Thread(target=self._drain_stderr, daemon=True).start()
+
+        self.version = 1
+        self.timeout = timeout
+        self._lock = threading.Lock()  # not pipelined - one request at a time
+        self._pending = {}  # request id / responses queue
+        self._values = queue.Queue()  # not pipelined - response values, None when the process has exited
+        self._next_id = 0
+        if protocol > 1:
+            self._write_line(f"protocol {protocol}")
+            self.version = int(self.process.stdout.readline())
+        reader = self._read_responses if self.version >= 3 else self._read_values
+        threading.Thread(target=reader, daemon=True).start()
+
+    def request(self, line, *data, count=1):
+        # returns the values of the response, None if it failed (empty response or timeout)
+        if self.version < 3:
+            with self._lock:
+                self._write_line(line, data)
+                return [self._next_value(line) for _ in range(count)]
+
+        responses = queue.Queue()
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = responses
+            self._write_line(f"{request_id} {line}", data)
+        try:
+            values = responses.get(timeout=self.timeout)
+            return values if len(values) >= count else None
+        except queue.Empty:
+            return None
+        finally:
+            self._pending.pop(request_id, None)
+
+    def request_stream(self, line, *data):
+        # streaming command, returns all messages until the empty one
+        if self.version < 3:
+            raise ValueError("Streaming commands need protocol 3")
+        responses = queue.Queue()
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = responses
+            self._write_line(f"{request_id} {line}", data)
+        try:
+            messages = []
+            while True:
+                try:
+                    values = responses.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No response to '{line}' in {self.timeout} sec") from None
+                if not values or values == [b""]:
+                    return messages
+                messages.append(values)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def peak_rss(self):
+        # kB, Linux only
+        try:
+            with open(f"/proc/{self.process.pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def close(self):
+        try:
+            with self._lock:
+                self._write_line("exit")
+            self.process.wait(5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+    def _write_line(self, line, data=()):
+        stdin = self.process.stdin
+        stdin.write((line + "\n").encode("utf-8"))
+        for item in data:
+            if self.version >= 2:
+                stdin.write(FRAME_HEADER.pack(len(item)))
+                stdin.write(item)
+            else:
+                stdin.write(base64.b64encode(item) + b"\n")
+        stdin.flush()
+
+    def _read_exactly(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise EOFError("Helper process has exited:\n" + "\n".join(self.stderr[-20:]))
+        return data
+
+    def _read_value(self):
+        if self.version >= 2:
+            return self._read_exactly(FRAME_HEADER.unpack(self._read_exactly(FRAME_HEADER.size))[0])
+        line = self.process.stdout.readline()
+        if not line:
+            raise EOFError("Helper process has exited:\n" + "\n".join(self.stderr[-20:]))
+        return line.rstrip(b"\n")
+
+    def _next_value(self, line):
+        # the failed requests aren't answered with the older protocols, so a late response would be read by the next
+        # request - kill the helper as HelperProcess.cs does
+        try:
+            value = self._values.get(timeout=self.timeout)
+        except queue.Empty:
+            self.process.kill()
+            raise TimeoutError(f"No response to '{line}' in {self.timeout} sec, the helper is killed") from None
+        if value is None:
+            raise EOFError("Helper process has exited:\n" + "\n".join(self.stderr[-20:]))
+        return value
+
+    def _read_values(self):
+        try:
+            while True:
+                self._values.put(self._read_value())
+        except EOFError:
+            self._values.put(None)
+
+    def _read_responses(self):
+        try:
+            while True:
+                request_id, count = MESSAGE_HEADER.unpack(self._read_exactly(MESSAGE_HEADER.size))
+                values = [self._read_value() for _ in range(count)]
+                responses = self._pending.get(request_id)
+                if responses is not None:
+                    responses.put(values)
+        except EOFError:
+            for responses in list(self._pending.values()):
+                responses.put([])
+
+    def _drain_stderr(self):
+        for line in self.process.stderr:
+            self.stderr.append(line.decode(errors="replace").rstrip())
+
+
+def run_scenario(client, name, func, requests, concurrency):
+    # func(i) sends one request and returns the response bytes count, None if it failed
+    latencies = []
+    sizes = []
+    failures = 0
+    errors = []
+
+    def execute(i):
+        start = time.perf_counter()
+        try:
+            size = func(i)
+        except (OSError, EOFError, TimeoutError, TypeError) as e:  # TypeError - None response of a failed request
+            errors.append(f"{type(e).__name__}: {e}")
+            size = None
+        return time.perf_counter() - start, size
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for latency, size in executor.map(execute, range(requests)):
+            if size is None:
+                failures += 1
+                continue
+            latencies.append(latency)
+            sizes.append(size)
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"{name}: {len(errors)} failed requests, first: {errors[0]}", file=sys.stderr, flush=True)
+
+    latencies.sort()
+    result = {"scenario": name, "requests": requests, "concurrency": concurrency, "failures": failures,
+              "throughput": round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+              "bytes_per_response": round(sum(sizes) / len(sizes)) if sizes else None,
+              "peak_rss_kb": client.peak_rss()}
+    for percentile in (50, 95, 99):
+        result[f"p{percentile}_ms"] = round(percentile_of(latencies, percentile) * 1000, 2) if latencies else None
+    result["mean_ms"] = round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None
+    print(json.dumps(result), flush=True)
+    return result
+
+
+def percentile_of(values, percentile):
+    # nearest rank of sorted values
+    return values[min(len(values) - 1, max(0, math.ceil(percentile / 100 * len(values)) - 1))]
+
+
+def generate_video(path, frames, size, fps=25):
+    import cv2
+    import numpy as np
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, size)
+    try:
+        noise = np.random.default_rng(0).integers(0, 40, (size[1], size[0], 3), dtype=np.uint8)
+        for i in range(frames):
+            img = noise.copy()
+            x = int((size[0] - 80) * (0.5 + 0.5 * math.sin(i / 20)))
+            cv2.rectangle(img, (x, size[1] // 3), (x + 80, size[1] // 3 + 80), (0, 200, 255), -1)
+            cv2.putText(img, str(i), (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+            writer.write(img)
+    finally:
+        writer.release()
+
+
+def encode_frames(path, count):
+    import cv2
+
+    capture = cv2.VideoCapture(path)
+    images = []
+    for _ in range(count):
+        result, img = capture.read()
+        if result:
+            images.append(cv2.imencode(".jpg", img)[1].tobytes())
+    capture.release()
+    return images
+
+
+def generate_audio(seconds, sample_rate=16000):
+    # voice-like tone bursts (s16le mono), so the VAD doesn't drop everything
+    samples = bytearray()
+    for i in range(int(seconds * sample_rate)):
+        t = i / sample_rate
+        envelope = max(0.0, math.sin(2 * math.pi * 3 * t))
+        value = envelope * (0.5 * math.sin(2 * math.pi * 180 * t) + 0.3 * math.sin(2 * math.pi * 360 * t))
+        samples += int(value * 12000).to_bytes(2, "little", signed=True)
+    return bytes(samples)
+
+
+def read_audio(path):
+    # WAV file to (pcm, sample rate, format, channels)
+    with wave.open(path, "rb") as file:
+        if file.getsampwidth() not in (2, 4):
+            raise ValueError("Only 16 and 32 bit WAV files are supported")
+        return (file.readframes(file.getnframes()), file.getframerate(),
+                "s16le" if file.getsampwidth() == 2 else "s32le", file.getnchannels())
+
+
+def benchmark_camera(options, directory):
+    results = []
+    frames = max(options.requests * 2, 250)
+    if options.address:
+        address = drop_address = options.address
+    else:
+        # separate files, dropOldFrames reads a file to its end
+        address = os.path.join(directory, "camera.avi")
+        generate_video(address, frames, options.frame_size)
+        drop_address = os.path.join(directory, "camera-drop.avi")
+        shutil.copy(address, drop_address)
+    images = encode_frames(address, 2)
+
+    client = HelperClient(os.path.join(os.path.dirname(__file__), "cameraCapture.py"),
+                          options.helper_args, options.protocol, options.timeout)
+    try:
+        def get_image(line):
+            def func(_):
+                values = client.request(line, count=2)
+                return len(values[1]) if values and values[0] == b"True" else None
+            return func
+
+        for opened in (address, drop_address):  # the captures are opened in background, wait for them
+            deadline = time.monotonic() + 30
+            while client.request(f"isOpened {opened}")[0] != b"True" and time.monotonic() < deadline:
+                time.sleep(0.1)
+        results.append(run_scenario(client, "getImage", get_image(f"getImage {address}"),
+                                    options.requests, options.concurrency))
+        results.append(run_scenario(client, "getImage 640,360 q80", get_image(f"getImage {address} True 640,360 True jpg 80"),
+                                    options.requests, options.concurrency))
+        results.append(run_scenario(client, "diffImages", lambda _: len(client.request("diffImages", *images)[0]),
+                                    options.requests, options.concurrency))
+        results.append(run_scenario(client, "dropOldFrames", lambda _: len(client.request(f"dropOldFrames {drop_address}")[0]),
+                                    min(options.requests, 5), 1))
+    finally:
+        client.close()
+    return results
+
+
+def benchmark_assistant(options, directory):
+    results = []
+    if options.audio:
+        audio, sample_rate, sample_format, channels = read_audio(options.audio)
+    else:
+        audio, sample_rate, sample_format, channels = generate_audio(options.audio_seconds), 16000, "s16le", 1
+
+    args = list(options.helper_args)
+    if options.whisper_model:
+        args += ["--whisper-model", options.whisper_model]
+    if options.piper_model:
+        args += ["--piper-model", options.piper_model]
+    client = HelperClient(os.path.join(os.path.dirname(__file__), "assistantHelper.py"), args, options.protocol,
+                          options.timeout)
+    try:
+        transcribe = f"transcribe {sample_rate} {sample_format} {channels}"
+        client.request(transcribe, audio)  # load the model
+        results.append(run_scenario(client, "transcribe", lambda _: len(client.request(transcribe, audio)[0]),
+                                    options.requests, options.concurrency))
+        if client.version >= 3:
+            results.append(run_scenario(client, "transcribeStream",
+                                        lambda _: sum(len(values[0]) for values in client.request_stream(
+                                            f"transcribeStream {sample_rate} {sample_format} {channels}", audio)),
+                                        options.requests, options.concurrency))
+
+        # unique texts, so the synthesis cache isn't used, and one text for the cached path
+        run_id = datetime.now().strftime("%H%M%S%f")
+        results.append(run_scenario(client, "synthesize",
+                                    lambda i: len(client.request("synthesize", f"{options.text} {run_id} {i}".encode())[0]),
+                                    options.requests, options.concurrency))
+        results.append(run_scenario(client, "synthesize cached",
+                                    lambda _: len(client.request("synthesize", options.text.encode())[0]),
+                                    options.requests, options.concurrency))
+    finally:
+        client.close()
+    return results
+
+
+def compare(results, path):
+    # p50/p95 and throughput changes against a previous run
+    with open(path, encoding="utf-8") as file:
+        previous = {(item["helper"], item["scenario"]): item for item in json.load(file)["results"]}
+    for item in results:
+        old = previous.get((item["helper"], item["scenario"]))
+        if old is None:
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms", "throughput"):
+            if old.get(key) and item.get(key) is not None:
+                changes.append(f"{key} {old[key]} -> {item[key]} ({(item[key] - old[key]) / old[key] * 100:+.1f}%)")
+        print(f"{item['helper']} {item['scenario']}: {', '.join(changes)}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the helper processes through their protocol")
+    parser.add_argument("helpers", nargs="*", choices=["camera", "assistant"], default=["camera"])
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="parallel requests, more than 1 needs protocol 3")
+    parser.add_argument("--protocol", type=int, default=3, choices=[1, 2, 3])
+    parser.add_argument("--helper-args", default="", help="extra arguments of the helper processes, e.g. \"--grab\"")
+    parser.add_argument("--address", help="camera address instead of a generated video file")
+    parser.add_argument("--frame-size", default="1280,720", help="width,height of the generated video")
+    parser.add_argument("--audio", help="WAV file instead of generated audio")
+    parser.add_argument("--audio-seconds", type=float, default=3)
+    parser.add_argument("--text", default="Здравей, как си днес?", help="text to synthesize")
+    parser.add_argument("--whisper-model", help="e.g. tiny, instead of the helper's default model")
+    parser.add_argument("--piper-model", help="piper .onnx model instead of the helper's default model")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="results of a previous run")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for a response")
+    options = parser.parse_args()
+    options.helper_args = options.helper_args.split()
+    options.frame_size = tuple(int(value) for value in options.frame_size.split(","))
+    if options.protocol < 3:
+        options.concurrency = 1
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for helper in options.helpers:
+            benchmark = benchmark_camera if helper == "camera" else benchmark_assistant
+            results.extend(dict(result, helper=helper) for result in benchmark(options, directory))
+
+    with open(options.output, "w", encoding="utf-8") as file:
+        json.dump({"commit": git_commit(), "time": datetime.now().isoformat(timespec="seconds"),
+                   "options": {key: value for key, value in vars(options).items() if key not in ("output", "compare")},
+                   "results": results}, file, indent=2, ensure_ascii=False)
+    if options.compare:
+        compare(results, options.compare)
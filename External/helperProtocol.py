@@ -0,0 +1,156 @@
+import base64
+import json
+import struct
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from helperStats import PROFILE_INTERVAL, stats
+
+# Protocol used by the helper processes (cameraCapture.py, assistantHelper.py) to talk with MyHome.
+# Requests are always text lines: "<command> [args...]\n".
+# Version 1 (default) - every response value is printed as a text line, binary data as python bytes repr of base64
+#   and binary request arguments are read as base64 lines.
+# Version 2 - after "protocol 2" request (answered with the accepted version as a text line)
+#   every response value and binary request argument is a frame: 4 bytes big-endian length + raw bytes.
+# Version 3 - as version 2, but requests are prefixed with an id: "<id> <command> [args...]\n" and executed
+#   in parallel, every response is a message: 4 bytes id + 4 bytes values count (big-endian) + the value frames,
+#   so responses can come out of order. Streaming commands send multiple messages with the same id.
+# Every helper also answers "stats [reset]" (JSON latency histograms per command and stage, memory, counters)
+# and "profile <on/off> [interval ms]" (sampling profiler, off answers with the collected stacks as JSON).
+PROTOCOL_VERSION = 3
+
+FRAME_HEADER = struct.Struct(">I")
+MESSAGE_HEADER = struct.Struct(">II")
+
+
+class Request:
+    def __init__(self, channel, id, line, data):
+        self.channel = channel
+        self.id = id
+        self.line = line
+        self.args = line.split()
+        self.command = self.args[0] if self.args else ""
+        self.data = data
+        self.responded = False
+        self.deferred = False  # the handler responds later, e.g. from a stream thread
+
+    def write(self, *values):
+        self.responded = True
+        self.channel.write(*values, request_id=self.id)
+
+
+class Channel:
+    def __init__(self, stdin=None, stdout=None):
+        self.stdin = stdin or sys.stdin.buffer
+        self.stdout = stdout or sys.stdout.buffer
+        self.version = 1
+        self._write_lock = threading.Lock()
+
+    @property
+    def binary(self):
+        return self.version >= 2
+
+    @property
+    def pipelined(self):
+        return self.version >= 3
+
+    def __iter__(self):
+        for line in self.stdin:
+            yield line.decode("utf-8")
+
+    # data_args - command / count of binary arguments sent after the request line
+    def requests(self, data_args):
+        for line in self:
+            id = 0
+            if self.pipelined:
+                parts = line.split(maxsplit=1)
+                if len(parts) == 2 and parts[0].isdigit():
+                    id, line = int(parts[0]), parts[1]
+            command = line.split()[0] if line.strip() else ""
+            data = [self.read_data() for _ in range(data_args.get(command, 0))]
+            yield Request(self, id, line, data)
+
+    def handshake(self, version):
+        # answer in the current mode and switch after that
+        accepted = max(1, min(int(version), PROTOCOL_VERSION))
+        self.write(accepted)
+        self.version = accepted
+
+    def read_data(self):
+        if not self.binary:
+            return base64.b64decode(self.stdin.readline())
+
+        header = self._read_exactly(FRAME_HEADER.size)
+        return self._read_exactly(FRAME_HEADER.unpack(header)[0])
+
+    def write(self, *values, request_id=None):
+        with stats.stage("write"), self._write_lock:
+            if self.pipelined and request_id is not None:
+                self.stdout.write(MESSAGE_HEADER.pack(request_id, len(values)))
+            for value in values:
+                if self.binary:
+                    data = value if isinstance(value, (bytes, bytearray, memoryview)) else str(value).encode("utf-8")
+                    self.stdout.write(FRAME_HEADER.pack(len(data)))
+                    self.stdout.write(data)
+                elif isinstance(value, (bytes, bytearray, memoryview)):
+                    self.stdout.write(f"{base64.b64encode(value)}\n".encode("utf-8"))  # keep b'...' format
+                else:
+                    self.stdout.write(f"{value}\n".encode("utf-8"))
+            self.stdout.flush()
+
+    def _read_exactly(self, size):
+        data = self.stdin.read(size)
+        if data is None or len(data) != size:
+            raise EOFError(f"Expected {size} bytes, but got {0 if data is None else len(data)}")
+        return data
+
+
+# read requests and execute them with the handler, in a thread pool if the protocol is pipelined
+# commands - known commands of the handler, the others are timed as "unknown", so garbage doesn't add histograms
+def serve(channel, handler, data_args=None, workers=4, commands=None):
+    def execute(request):
+        known = commands is None or request.command in commands or request.command in ("stats", "profile")
+        try:
+            with stats.command(request.command if known else "unknown"):
+                if request.command in ("stats", "profile"):
+                    handle_stats(request)
+                else:
+                    handler(request)
+        except Exception:
+            sys.stderr.write(f"Failed to execute command {request.line.strip()}:\n{traceback.format_exc()}\n")
+            if channel.pipelined and not request.responded:  # streams end themselves, e.g. in finally
+                request.write()  # empty response, so the caller doesn't wait for it
+            return
+        if channel.pipelined and not request.responded and not request.deferred:
+            request.write()  # command without response or unknown one, so the caller doesn't wait for it
+
+    pool = ThreadPoolExecutor(workers)
+    try:
+        for request in channel.requests(data_args or {}):
+            if request.command == "protocol":  # protocol <version>
+                channel.handshake(request.args[1])
+            elif request.command == "exit":
+                break
+            elif channel.pipelined:
+                pool.submit(execute, request)
+            else:
+                execute(request)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def handle_stats(request):
+    args = request.args
+    if request.command == "stats":  # stats [reset]
+        request.write(json.dumps(stats.snapshot()))
+        if len(args) > 1 and args[1] == "reset":
+            stats.reset()
+
+    if request.command == "profile":  # profile <on/off> [interval ms]
+        if args[1].lower() == "on":
+            stats.profile(True, float(args[2]) / 1000 if len(args) > 2 else PROFILE_INTERVAL)
+            request.write(True)
+        else:
+            request.write(json.dumps(stats.profile(False)))
@@ -0,0 +1,227 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Latency of the helper commands and their internal stages, so slow requests can be explained:
+#   with stats.stage("encode"):  # inside a command, recorded as (command, "encode")
+#       ...
+# Every command executed by helperProtocol.serve is timed as its "total" stage, background threads
+# use stats.command(name). The histograms are rolling - only the last one or two windows are kept.
+WINDOW = 300  # seconds
+BUCKETS = [2 ** i / 1000 for i in range(-4, 18)]  # upper bounds in seconds, 62.5 us to 131 s, log2 scale
+PERCENTILES = (50, 95, 99)
+
+PROFILE_INTERVAL = 0.005  # seconds between the samples of the profiler
+PROFILE_DEPTH = 30  # frames per stack
+PROFILE_TOP = 30  # stacks in the stats
+PROFILE_MAX_STACKS = 2000  # distinct stacks kept while profiling, the rarest half is dropped above it
+
+
+class Histogram:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = [0] * (len(BUCKETS) + 1)
+        self._previous = [0] * (len(BUCKETS) + 1)
+        self._sum = [0.0, 0.0]  # current, previous
+        self._max = [0.0, 0.0]
+        self._started = time.monotonic()
+
+    def add(self, seconds):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self._rotate()
+            self._current[index] += 1
+            self._sum[0] += seconds
+            self._max[0] = max(self._max[0], seconds)
+
+    def summary(self):
+        # milliseconds, the percentiles are the upper bounds of their buckets
+        with self._lock:
+            self._rotate()
+            counts = [a + b for a, b in zip(self._current, self._previous)]
+            total, max_time = sum(self._sum), max(self._max)
+        count = sum(counts)
+        if count == 0:
+            return {"count": 0}
+
+        result = {"count": count, "mean": round(total / count * 1000, 3), "max": round(max_time * 1000, 3)}
+        for percentile in PERCENTILES:
+            rank, cumulative = count * percentile / 100, 0
+            for index, bucket_count in enumerate(counts):
+                cumulative += bucket_count
+                if cumulative >= rank:
+                    break
+            result[f"p{percentile}"] = round(min(BUCKETS[index] if index < len(BUCKETS) else max_time, max_time) * 1000, 3)
+        return result
+
+    def _rotate(self):
+        # call with the lock
+        elapsed = time.monotonic() - self._started
+        if elapsed < WINDOW:
+            return
+        if elapsed < 2 * WINDOW:
+            self._previous, self._current = self._current, self._previous
+            self._sum, self._max = [0.0, self._sum[0]], [0.0, self._max[0]]
+        else:  # nothing in the last window
+            self._previous = [0] * len(self._previous)
+            self._sum, self._max = [0.0, 0.0], [0.0, 0.0]
+        self._current = [0] * len(self._current)
+        self._started = time.monotonic()
+
+
+class Timer:
+    # context manager, cheaper than contextlib
+    __slots__ = ("stats", "command", "stage", "start", "previous")
+
+    def __init__(self, stats, command, stage):
+        self.stats = stats
+        self.command = command
+        self.stage = stage
+
+    def __enter__(self):
+        if self.command is not None:
+            self.previous = getattr(self.stats._local, "command", None)
+            self.stats._local.command = self.command
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        elapsed = time.perf_counter() - self.start
+        self.stats.record(self.stage, elapsed, self.command)
+        if self.command is not None:
+            self.stats._local.command = self.previous
+
+
+class SamplingProfiler(threading.Thread):
+    # sample the stacks of the other threads, so the busy functions are found without tracing every call
+    def __init__(self, interval=PROFILE_INTERVAL):
+        super().__init__(daemon=True, name="Sampling profiler")
+        self.interval = interval
+        self.stacks = Counter()  # "file:line function;..." from the outermost frame
+        self.samples = 0
+        self.started = time.time()
+        self.running = True
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < PROFILE_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            if len(self.stacks) > PROFILE_MAX_STACKS:
+                self.stacks = Counter(dict(self.stacks.most_common(PROFILE_MAX_STACKS // 2)))
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def summary(self):
+        return {"running": self.running, "seconds": round(time.time() - self.started, 1), "samples": self.samples,
+                "interval": self.interval, "stacks": dict(self.stacks.most_common(PROFILE_TOP))}
+
+
+class Stats:
+    def __init__(self):
+        self._histograms = {}  # (command, stage) / Histogram
+        self._counters = Counter()
+        self._load_times = {}  # model or resource / seconds
+        self._info = {}  # name / function returning json serializable value
+        self._lock = threading.Lock()
+        self._local = threading.local()  # the command executed by the thread
+        self._profiler = None
+        self.started = time.time()
+
+    def command(self, name):
+        # time the block as the "total" of the command and record the stages inside it under the command
+        return Timer(self, name, "total")
+
+    def stage(self, name):
+        return Timer(self, None, name)
+
+    def record(self, stage, seconds, command=None):
+        key = (command or getattr(self._local, "command", None) or "background", stage)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.add(seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def load(self, name):
+        return LoadTimer(self, name)
+
+    def add_info(self, name, func):
+        # extra values of the helper, evaluated when the stats are requested
+        self._info[name] = func
+
+    def profile(self, enabled, interval=PROFILE_INTERVAL):
+        # returns the summary of the stopped profiler
+        with self._lock:
+            profiler = self._profiler
+            if enabled:
+                if profiler is None or not profiler.running:
+                    self._profiler = SamplingProfiler(interval)
+                    self._profiler.start()
+                return None
+            if profiler is not None:
+                profiler.running = False
+        return profiler.summary() if profiler is not None else None
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        commands = {}
+        for (command, stage), histogram in sorted(self._histograms.copy().items()):
+            commands.setdefault(command, {})[stage] = histogram.summary()
+        with self._lock:
+            counters = dict(self._counters)
+        result = {"uptime": round(time.time() - self.started), "window": WINDOW, "memory": memory_usage(),
+                  "commands": commands, "counters": counters, "load_times": dict(self._load_times)}
+        for name, func in list(self._info.items()):
+            result[name] = func()
+        if self._profiler is not None:
+            result["profile"] = self._profiler.summary()
+        return result
+
+
+class LoadTimer:
+    __slots__ = ("stats", "name", "start")
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self.stats._load_times[self.name] = round(time.perf_counter() - self.start, 3)
+
+
+def memory_usage():
+    # KB, current and peak resident set size
+    try:
+        with open("/proc/self/status") as file:
+            values = dict(line.split(":", 1) for line in file if line.startswith(("VmRSS", "VmHWM")))
+        return {"rss": int(values["VmRSS"].split()[0]), "peak_rss": int(values["VmHWM"].split()[0])}
+    except (OSError, KeyError, ValueError):
+        import resource  # not on Windows
+        return {"rss": None, "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+stats = Stats()
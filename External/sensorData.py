@@ -0,0 +1,278 @@
+import argparse
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from datetime import datetime, timedelta
+
+# Columnar sensor data file (.mhsd), all values are little-endian, every column starts at an 8 bytes boundary:
+#   header     magic "MHSD", version (uint16), flags (uint16), columns count (uint32), rows count (uint64), 4 bytes padding
+#   directory  per column: type code (char: q - int64, h - int16, f - float32), padding, name length (uint16),
+#              4 bytes padding, data offset (uint64)
+#   names      the column names (UTF-8) one after another
+#   data       per column: rows count values
+# The first column is "Time" - .NET DateTime ticks (100 ns since 0001-01-01) of the sensor data keys (local time), in order
+# as the DateTime keys of the sensor (the same local times by UTC).
+# With FLAG_OFFSETS the second column is "Offset" - UTC offset of the keys in minutes, NO_OFFSET for the keys without it.
+# The other columns are the sensor sub-names (float32), NaN if a sample doesn't have the value.
+MAGIC = b"MHSD"
+VERSION = 1
+FLAG_OFFSETS = 1
+HEADER = struct.Struct("<4sHHIQ4x")
+DIRECTORY_ENTRY = struct.Struct("<cxH4xQ")
+TIME_COLUMN = "Time"
+OFFSET_COLUMN = "Offset"
+NO_OFFSET = -32768
+
+TICKS_PER_SECOND = 10_000_000
+EPOCH = datetime(1, 1, 1)
+
+
+def parse_time(value):
+    # .NET round-trip format: 2024-01-02T03:04:05.1234567+02:00, fraction and offset are optional
+    offset = None
+    if value.endswith("Z"):
+        value, offset = value[:-1], 0
+    elif len(value) > 19 and value[-6] in "+-":
+        sign = -1 if value[-6] == "-" else 1
+        offset = sign * (int(value[-5:-3]) * 60 + int(value[-2:]))
+        value = value[:-6]
+
+    value, _, fraction = value.partition(".")
+    delta = datetime.fromisoformat(value) - EPOCH
+    ticks = (delta.days * 86400 + delta.seconds) * TICKS_PER_SECOND + int(fraction.ljust(7, "0")[:7] or 0)
+    return ticks, offset
+
+
+def format_time(ticks, offset=None):
+    seconds, fraction = divmod(ticks, TICKS_PER_SECOND)
+    result = (EPOCH + timedelta(seconds=seconds)).isoformat()
+    if fraction:
+        result += "." + f"{fraction:07d}".rstrip("0")
+    if offset is not None:
+        result += f"{'-' if offset < 0 else '+'}{abs(offset) // 60:02d}:{abs(offset) % 60:02d}"
+    return result
+
+
+def format_value(value):
+    # the shortest text which is the same float32
+    packed = struct.pack("<f", value)
+    for precision in range(6, 10):
+        text = f"{value:.{precision}g}"
+        if struct.pack("<f", float(text)) == packed:
+            return float(text)
+    return value
+
+
+def read_json(path):
+    # sensor data json ({time: {sub-name: value}}) to (times, offsets or None, {sub-name: values})
+    with open(path, "r", encoding="utf-8-sig") as file:
+        data = json.load(file)
+
+    samples = []
+    for key, values in data.items():
+        if key.startswith("$"):  # $id / $type of the type name handling serialization
+            continue
+        ticks, offset = parse_time(key)
+        samples.append((ticks, offset, values))
+    samples.sort(key=lambda sample: (sample[0], sample[0] - (sample[1] or 0) * 60 * TICKS_PER_SECOND))
+
+    names = sorted({name for _, _, values in samples for name in values if not name.startswith("$")})
+    times = array("q", (sample[0] for sample in samples))
+    offsets = array("h", (sample[1] if sample[1] is not None else NO_OFFSET for sample in samples)) \
+        if any(sample[1] is not None for sample in samples) else None
+    columns = {name: array("f", (float(values.get(name, math.nan)) for _, _, values in samples)) for name in names}
+    return times, offsets, columns
+
+
+def write_json(path, times, offsets, columns, indent=None):
+    data = {}
+    for i, ticks in enumerate(times):
+        offset = offsets[i] if offsets is not None and offsets[i] != NO_OFFSET else None
+        data[format_time(ticks, offset)] = {
+            name: format_value(values[i]) for name, values in columns.items() if not math.isnan(values[i])}
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=indent)
+
+
+def write_columnar(path, times, offsets, columns):
+    all_columns = [(TIME_COLUMN, array("q", times))]
+    if offsets is not None:
+        all_columns.append((OFFSET_COLUMN, array("h", offsets)))
+    all_columns.extend((name, array("f", values)) for name, values in columns.items())
+    for _, values in all_columns:
+        if len(values) != len(times):
+            raise ValueError("All columns must have the same length")
+
+    names = [name.encode() for name, _ in all_columns]
+    offset = align(HEADER.size + DIRECTORY_ENTRY.size * len(all_columns) + sum(len(name) for name in names))
+    data_offsets = []
+    for _, values in all_columns:
+        data_offsets.append(offset)
+        offset = align(offset + len(values) * values.itemsize)
+
+    with open(path + ".tmp", "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, FLAG_OFFSETS if offsets is not None else 0, len(all_columns), len(times)))
+        for (_, values), name, data_offset in zip(all_columns, names, data_offsets):
+            file.write(DIRECTORY_ENTRY.pack(values.typecode.encode(), len(name), data_offset))
+        for name in names:
+            file.write(name)
+        for (_, values), data_offset in zip(all_columns, data_offsets):
+            file.write(b"\0" * (data_offset - file.tell()))
+            if sys.byteorder != "little":
+                values = array(values.typecode, values)
+                values.byteswap()
+            values.tofile(file)
+    os.replace(path + ".tmp", path)
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+class SensorData:
+    # memory-mapped reader, the columns are views of the file (copied only on big-endian machines)
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.flags, count, self.rows = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self._mmap.close()
+            raise ValueError(f"Invalid sensor data file: {path}")
+
+        entries = [DIRECTORY_ENTRY.unpack_from(self._mmap, HEADER.size + i * DIRECTORY_ENTRY.size) for i in range(count)]
+        position = HEADER.size + DIRECTORY_ENTRY.size * count
+        self._columns = {}
+        for typecode, name_length, data_offset in entries:
+            name = self._mmap[position:position + name_length].decode()
+            position += name_length
+            typecode = typecode.decode()
+            size = array(typecode).itemsize * self.rows
+            values = memoryview(self._mmap)[data_offset:data_offset + size].cast(typecode)
+            if sys.byteorder != "little":
+                values = array(typecode, values)
+                values.byteswap()
+            self._columns[name] = values
+
+    @property
+    def times(self):
+        return self._columns[TIME_COLUMN]
+
+    @property
+    def offsets(self):
+        return self._columns.get(OFFSET_COLUMN)
+
+    @property
+    def names(self):
+        return [name for name in self._columns if name not in (TIME_COLUMN, OFFSET_COLUMN)]
+
+    def column(self, name):
+        return self._columns[name]
+
+    def range(self, start_ticks, end_ticks):
+        # rows slice of the samples in [start, end)
+        return slice(bisect.bisect_left(self.times, start_ticks), bisect.bisect_left(self.times, end_ticks))
+
+    def close(self):
+        self._columns.clear()  # the views must be released before the map is closed
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def convert_to_columnar(json_path, path):
+    times, offsets, columns = read_json(json_path)
+    write_columnar(path, times, offsets, columns)
+    return len(times)
+
+
+def convert_to_json(path, json_path, indent=None):
+    with SensorData(path) as data:
+        write_json(json_path, data.times, data.offsets, {name: data.column(name) for name in data.names}, indent)
+        return data.rows
+
+
+def benchmark(json_paths, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        if not json_paths:
+            json_paths = [generate_json(os.path.join(directory, "generated.json"))]
+
+        for json_path in json_paths:
+            path = os.path.join(directory, os.path.basename(json_path) + ".mhsd")
+            convert_to_columnar(json_path, path)
+
+            json_time = measure(lambda: load_json(json_path), repeat)
+            columnar_time = measure(lambda: load_columnar(path), repeat)
+            results.append({"file": json_path, "json_size": os.path.getsize(json_path), "columnar_size": os.path.getsize(path),
+                            "json_load": json_time, "columnar_load": columnar_time})
+    return results
+
+
+def generate_json(path, rows=365 * 24 * 60, names=("temperature", "humidity", "battery")):
+    # a year of samples every minute with local time keys as saved by BaseSensor
+    start = datetime(2024, 1, 1)
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump({(start + timedelta(minutes=i)).isoformat() + ".1234567+02:00":
+                   {name: round(20 + 5 * math.sin(i / 600 + j), 2) for j, name in enumerate(names)}
+                   for i in range(rows)}, file)
+    return path
+
+
+def load_json(path):
+    # the samples and their values, like BaseSensor.Setup
+    with open(path, "r", encoding="utf-8-sig") as file:
+        data = json.load(file)
+    return sum(len(values) for values in data.values())
+
+
+def load_columnar(path):
+    # open and copy every column to memory
+    with SensorData(path) as data:
+        return sum(len(array(data.column(name).format, data.column(name))) for name in [TIME_COLUMN] + data.names)
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Columnar sensor data files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    to_columnar = subparsers.add_parser("to-columnar", help="convert sensor data json to columnar file")
+    to_columnar.add_argument("json")
+    to_columnar.add_argument("output", nargs="?")
+    to_json = subparsers.add_parser("to-json", help="convert columnar file to sensor data json")
+    to_json.add_argument("input")
+    to_json.add_argument("output", nargs="?")
+    to_json.add_argument("--indent", type=int, default=None)
+    bench = subparsers.add_parser("bench", help="compare load time and size with the json, generates a year of data if no files")
+    bench.add_argument("json", nargs="*")
+    bench.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "to-columnar":
+        output = args.output or os.path.splitext(args.json)[0] + ".mhsd"
+        print(f"{convert_to_columnar(args.json, output)} samples written to {output}")
+    elif args.command == "to-json":
+        output = args.output or os.path.splitext(args.input)[0] + ".json"
+        print(f"{convert_to_json(args.input, output, args.indent)} samples written to {output}")
+    else:
+        for result in benchmark(args.json, args.repeat):
+            print(json.dumps(result))
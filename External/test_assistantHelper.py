@@ -0,0 +1,109 @@
+# python3 -m unittest discover -s External
+import unittest
+
+import numpy as np
+
+try:
+    import assistantHelper
+except ImportError:  # faster_whisper or piper isn't installed
+    assistantHelper = None
+
+RATE = 16000
+
+
+def tone(seconds, level_db=-20.0, frequency=200.0):
+    # voiced-like signal: loud and with low zero-crossing rate
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (10 ** (level_db / 20) * np.sqrt(2) * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+@unittest.skipIf(assistantHelper is None, "assistantHelper dependencies aren't installed")
+class SpeechGateTest(unittest.TestCase):
+    def test_silence(self):
+        gate = assistantHelper.speech_gate(np.zeros(RATE, np.float32))
+        self.assertFalse(gate["speech"])
+
+    def test_hiss(self):
+        noise = np.random.default_rng(1).normal(0, 0.05, RATE).astype(np.float32)
+        self.assertFalse(assistantHelper.speech_gate(noise)["speech"])
+
+    def test_voiced_with_silence_is_trimmed(self):
+        audio = np.concatenate((np.zeros(RATE, np.float32), tone(1.0), np.zeros(RATE, np.float32)))
+        gate = assistantHelper.speech_gate(audio)
+        self.assertTrue(gate["speech"])
+        self.assertAlmostEqual(gate["start"], 1.0 - assistantHelper.GATE_PADDING, delta=0.05)
+        self.assertAlmostEqual(gate["end"], 2.0 + assistantHelper.GATE_PADDING, delta=0.05)
+
+    def test_fully_voiced(self):
+        # trimmed push-to-talk clip without silence, the noise floor is the speech itself
+        audio = np.concatenate([tone(0.2, -20.0 if i % 2 == 0 else -35.0) for i in range(10)])  # syllables
+        gate = assistantHelper.speech_gate(audio)
+        self.assertTrue(gate["speech"])
+        self.assertGreaterEqual(gate["voiced"], 0.95)
+
+    def test_fully_voiced_modulated(self):
+        t = np.arange(2 * RATE) / RATE
+        audio = tone(2.0) * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t)).astype(np.float32)
+        gate = assistantHelper.speech_gate(audio)
+        self.assertTrue(gate["speech"])
+        self.assertGreaterEqual(gate["voiced"], 1.9)
+
+    def test_loud_stationary_noise(self):
+        # TV or music hum, loud and with low zero-crossing rate, but without syllables
+        noise = np.convolve(np.random.default_rng(1).normal(0, 1, 2 * RATE), np.ones(16) / 16, "same")
+        noise = (noise / np.sqrt(np.mean(noise ** 2)) * 10 ** (-25 / 20)).astype(np.float32)
+        chord = tone(2.0, -18.0, 110.0) + tone(2.0, -20.0, 165.0) + tone(2.0, -22.0, 220.0)
+        self.assertFalse(assistantHelper.speech_gate(noise)["speech"])
+        self.assertFalse(assistantHelper.speech_gate(chord + noise)["speech"])
+
+
+@unittest.skipIf(assistantHelper is None, "assistantHelper dependencies aren't installed")
+class ConvertTest(unittest.TestCase):
+    SAMPLES = np.array([0.0, 0.5, -0.5, -1.0])
+
+    def convert(self, data, sample_format, channels=1):
+        return assistantHelper.AudioBuffer().convert(data, RATE, sample_format, channels)
+
+    def test_u8(self):
+        data = (self.SAMPLES * 128 + 128).astype(np.uint8).tobytes()
+        np.testing.assert_allclose(self.convert(data, "u8"), self.SAMPLES)
+
+    def test_s24le(self):
+        values = (self.SAMPLES * 2 ** 23).astype("<i4")
+        data = b"".join(value.tobytes()[:3] for value in values)
+        np.testing.assert_allclose(self.convert(data, "s24le"), self.SAMPLES)
+
+    def test_s24le_stereo(self):
+        values = (np.repeat(self.SAMPLES, 2) * 2 ** 23).astype("<i4")
+        data = b"".join(value.tobytes()[:3] for value in values)
+        np.testing.assert_allclose(self.convert(data, "s24le", 2), self.SAMPLES)
+
+
+class FakeVad:
+    def __init__(self):
+        self.inputs = []
+
+    def run(self, _, inputs):
+        self.inputs.append(inputs["input"])
+        return np.array([[0.9]], np.float32), inputs["state"]
+
+
+@unittest.skipIf(assistantHelper is None, "assistantHelper dependencies aren't installed")
+class VadTest(unittest.TestCase):
+    def test_chunks_with_context(self):
+        fake = FakeVad()
+        previous, assistantHelper.vad = assistantHelper.vad, fake
+        try:
+            audio = tone(0.1)
+            self.assertEqual(assistantHelper.vad_probability(audio), 0.9)
+        finally:
+            assistantHelper.vad = previous
+
+        chunk, context = assistantHelper.GATE_VAD_CHUNK, assistantHelper.GATE_VAD_CONTEXT
+        self.assertEqual([x.shape for x in fake.inputs], [(1, context + chunk)] * (len(audio) // chunk))
+        self.assertTrue(np.all(fake.inputs[0][0, :context] == 0))
+        np.testing.assert_array_equal(fake.inputs[1][0, :context], audio[chunk - context:chunk])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -94,6 +94,12 @@ public class Config
         [UiProperty(true, "MB per camera")]
         public double CameraRecordsDiskUsage { get; set; } = 200;
 
+        [UiProperty(true, "read frames continuously, restart needed")]
+        public bool CameraBackgroundCapture { get; set; } = false;
+
+        [UiProperty(true, "shared by all cameras, restart needed")]
+        public int CameraCaptureProcesses { get; set; } = 1;
+
         [UiProperty(true)]
         public string SongsPath { get; set; } = Path.Combine(BinPath, "Songs");
 
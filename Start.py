@@ -1,19 +1,19 @@
 #!/usr/bin/python3.7
 # pylint: disable=global-statement
+import argparse
+import http.client
+import json
 import logging
 import logging.handlers
 import os
 import signal
 import subprocess
 import sys
+import threading
 import time
+from collections import deque
 from datetime import datetime, timedelta
-
-# fix issue in robobrowser
-import werkzeug
-werkzeug.cached_property = werkzeug.utils.cached_property
-
-import robobrowser
+from urllib.parse import urlsplit
 
 logging_stdout_handler = logging.StreamHandler()
 logging_file_handler = logging.handlers.RotatingFileHandler(
@@ -26,6 +26,10 @@ logging.basicConfig(format="%(asctime)s.%(msecs)03d %(levelname)-7s %(message)s"
 logger = logging.getLogger()
 
 proc = None
+stderrTail = deque(maxlen=100)  # last stderr lines of the process, logged when it exits
+metrics = {"started": datetime.now().isoformat(timespec="seconds"), "restarts": 0, "last_start": None,
+           "startup_time": None, "last_exit_code": None, "probes": 0, "failed_probes": 0,
+           "probe_latency": {"last": None, "avg": None, "max": None}}
 
 
 def killProc():
@@ -57,14 +61,90 @@ def signal_handler(_, __):
     sys.exit(0)
 
 
-# args - Start.py "command" "web address"
-if len(sys.argv) < 3:
-    sys.argv.append("/home/pi/.dotnet/dotnet run -c Release -launch-profile \"MyHome\"")
-    sys.argv.append("http://localhost:5000/api/status")
+def drainStderr(stream):
+    # read continuously, so the process doesn't block on a full pipe
+    for line in iter(stream.readline, b""):
+        stderrTail.append(line.decode(errors="replace").rstrip())
+    stream.close()
+
+
+class Prober:
+    # health probe over a kept-alive connection, reconnects after a failure
+    def __init__(self, url, timeout):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += "?" + parts.query
+        self.connectionType = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.timeout = timeout
+        self.connection = None
+
+    def probe(self):
+        start = time.monotonic()
+        try:
+            if self.connection is None:
+                self.connection = self.connectionType(self.host, self.port, timeout=self.timeout)
+            self.connection.request("GET", self.path)
+            response = self.connection.getresponse()
+            response.read()  # the response must be read before the connection is reused
+            if response.status != 200:
+                raise http.client.HTTPException(f"Status {response.status} {response.reason}")
+            return time.monotonic() - start
+        except Exception as e:
+            logger.debug(f"Probe failed: {e}")
+            self.close()
+            return None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def updateMetrics(latency):
+    metrics["probes"] += 1
+    if latency is None:
+        metrics["failed_probes"] += 1
+        return
+
+    probeLatency = metrics["probe_latency"]
+    okProbes = metrics["probes"] - metrics["failed_probes"]
+    probeLatency["last"] = round(latency, 4)
+    probeLatency["avg"] = round(((probeLatency["avg"] or 0) * (okProbes - 1) + latency) / okProbes, 4)
+    probeLatency["max"] = max(probeLatency["max"] or 0, probeLatency["last"])
+
+
+def writeMetrics(path):
+    if not path:
+        return
+    try:
+        with open(path + ".tmp", "w") as file:
+            json.dump(metrics, file, indent=2)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.debug(f"Failed to write metrics: {e}")
+
+
+parser = argparse.ArgumentParser(description="Start the process and restart it if it exits or stops responding")
+parser.add_argument("command", nargs="?", default="/home/pi/.dotnet/dotnet run -c Release -launch-profile \"MyHome\"")
+parser.add_argument("url", nargs="?", default="http://localhost:5000/api/status", help="health probe address")
+# the restart comes after (interval + timeout) * failures without a response, the process could block for minutes
+# (e.g. archiving the camera records or GC on a Raspberry Pi), lower values restart it in the middle of such work
+parser.add_argument("--probe-interval", type=float, default=30, help="seconds between the probes")
+parser.add_argument("--probe-timeout", type=float, default=10, help="seconds to wait for a probe response")
+parser.add_argument("--failures", type=int, default=5,
+                    help="failed probes in a row before restart, ~3 min with the defaults")
+parser.add_argument("--startup-timeout", type=float, default=300, help="seconds to wait for the first healthy probe")
+parser.add_argument("--metrics", default="bin/starter.json", help="metrics file, empty to disable")
+parser.add_argument("--metrics-interval", type=float, default=60, help="seconds between the metrics file updates")
+args = parser.parse_args()
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
+prober = Prober(args.url, args.probe_timeout)
 lastRestartTime = datetime.now()
 restartCount = 0
 while True:
@@ -79,33 +159,55 @@ while True:
 
     try:
         killProc()
-        proc = subprocess.Popen(sys.argv[1].split(), stderr=subprocess.PIPE)
-
-        while (proc is not None) and (proc.poll() is None):
-            for i in range(0, 12):  # wait a minute
-                time.sleep(5)
-                if (proc is None) or (proc.poll() is not None):
-                    break
-
-            if (proc is None) or (proc.poll() is not None):
+        prober.close()
+        stderrTail.clear()
+        proc = subprocess.Popen(args.command.split(), stderr=subprocess.PIPE)
+        drainThread = threading.Thread(target=drainStderr, args=(proc.stderr,), daemon=True)
+        drainThread.start()
+        startTime = time.monotonic()
+        metrics["last_start"] = datetime.now().isoformat(timespec="seconds")
+        writeMetrics(args.metrics)
+
+        healthy = False
+        failures = 0
+        lastMetricsTime = time.monotonic()
+        while True:
+            # wake up immediately if the process exits
+            try:
+                proc.wait(args.probe_interval)
+            except subprocess.TimeoutExpired:
+                pass
+            if proc.poll() is not None:
+                drainThread.join(1)
                 logger.error(f"Process isn't running, so try to restart it (ExitCode: {proc.returncode})")
-                logger.error(proc.communicate()[1])
+                logger.error("\n".join(stderrTail))
+                metrics["last_exit_code"] = proc.returncode
                 break
 
-            # try open page 3 times
-            kill = True
-            for i in range(0, 3):
-                try:
-                    br = robobrowser.RoboBrowser(timeout=30)
-                    br.open(sys.argv[2])
-                    kill = False
-                    break
-                except Exception as e:
-                    logger.debug(str(e))
-                    time.sleep(30)
-            if kill:
-                logger.error("Cannot open the web page try to restart")
+            latency = prober.probe()
+            updateMetrics(latency)
+            if latency is not None:
+                if not healthy:
+                    healthy = True
+                    metrics["startup_time"] = round(time.monotonic() - startTime, 1)
+                    logger.info(f"Process is healthy after {metrics['startup_time']} sec")
+                    writeMetrics(args.metrics)
+                failures = 0
+            elif healthy:
+                failures += 1
+            if time.monotonic() - lastMetricsTime > args.metrics_interval:
+                lastMetricsTime = time.monotonic()
+                writeMetrics(args.metrics)
+
+            if failures >= args.failures:
+                logger.error(f"Cannot open the web page {failures} times, try to restart")
                 break
+            if not healthy and time.monotonic() - startTime > args.startup_timeout:
+                logger.error(f"Process isn't healthy {args.startup_timeout} sec after start, try to restart")
+                break
+
+        metrics["restarts"] += 1
+        writeMetrics(args.metrics)
         logger.info("")
     except (KeyboardInterrupt, SystemExit) as e:
         killProc()
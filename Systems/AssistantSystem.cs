@@ -54,13 +54,17 @@ public class HistoryItem
     [UiProperty(true)]
     public bool Speak { get; set; }
 
+    [UiProperty(true, "load models on start, restart needed")]
+    public bool WarmUp { get; set; }
+
 
     [JsonIgnore]
     public Dictionary<string, (DateTime time, byte[] data)> SpeakResponses { get; }
 
 
-    private readonly object helperLock = new();
-    private Process helper;
+    private static readonly TimeSpan HelperTimeout = TimeSpan.FromMinutes(1); // wait for a helper response
+    private static readonly byte[] WaveSubFormatSuffix = new byte[] { 0, 0, 0, 0, 0x10, 0, 0x80, 0, 0, 0xAA, 0, 0x38, 0x9B, 0x71 }; // of the extensible sub-format GUID
+    private HelperProcess helper;
     private DateTime minuteUpdateTime = DateTime.Now;
 
 
@@ -78,6 +82,7 @@ public AssistantSystem()
         this.UnknownRequestResponse = "Не знам как да отговоря на това. Може да го добавите в Request Mapping на Assistant страницата.";
         this.DontUnderstandResponse = "Съжалявам, но не ви разбрах. Моля повторете!";
         this.Speak = true;
+        this.WarmUp = true;
 
         this.SpeakResponses = new Dictionary<string, (DateTime time, byte[] data)>();
     }
@@ -85,18 +90,18 @@ public AssistantSystem()
     public override void Setup()
     {
         base.Setup();
-        this.helper = Utils.Utils.StartProcess("python3", "../External/assistantHelper.py", Models.Config.BinPath, false, logger);
+        var args = this.WarmUp ? " --warmup" : "";
+        this.helper = new HelperProcess("python3", "../External/assistantHelper.py" + args, Models.Config.BinPath, false, logger)
+        {
+            LockTimeout = TimeSpan.FromSeconds(10)
+        };
+        this.helper.EnsureStarted();
     }
 
     public override void Stop()
     {
         base.Stop();
-        if (!this.helper.HasExited)
-        {
-            this.helper.StandardInput.WriteLine("exit"); // stop helper process
-            if (!this.helper.HasExited)
-                this.helper.Kill();
-        }
+        this.helper.Stop(); // stop helper process
     }
 
     protected override void Update()
@@ -118,6 +123,12 @@ protected override void Update()
 
     // TODO: actions on event (e.g. security alarm activated)
 
+    // stats of the helper process (latency per command and stage, model load times), null if it doesn't respond
+    public JToken GetHelperStats()
+    {
+        return Utils.Utils.TryParseJson(this.helper?.GetStats(TimeSpan.FromSeconds(10)), out var stats) ? stats : null;
+    }
+
     public void ProcessRequest(string request)
     {
         if (string.IsNullOrEmpty(request))
@@ -166,7 +177,7 @@ public string ExecuteOperation(string operation, string args)
     public void ProcessRecord(byte[] data)
     {
         var result = this.Transcribe(data);
-        var request = string.Join("", result.Select(i => i[2]));
+        var request = string.Join("", result?.Select(i => i[2]) ?? []);
         if (string.IsNullOrEmpty(request))
         {
             this.AddToHistory(this.DontUnderstandResponse, true);
@@ -204,32 +215,88 @@ private void AddToHistory(string item, bool response)
 
     private JArray Transcribe(byte[] data)
     {
-        if (Monitor.TryEnter(this.helperLock, TimeSpan.FromSeconds(10)))
+        // send raw PCM samples with their format, segments are sent back as soon as they are decoded, empty data at the end
+        // other WAV formats are sent as whole file, decoded by FFmpeg in the helper
+        var wav = ParseWav(data);
+        using var request = wav is (var offset, var length, var sampleRate, var format, var channels)
+            ? this.helper.Send($"transcribeStream {sampleRate} {format} {channels}", data[offset..(offset + length)])
+            : this.helper.Send("transcribeStream 16000 file 1", data);
+        if (request == null)
+            return null;
+
+        var result = new JArray();
+        while (true)
         {
-            try
+            var segment = request.Read(1, HelperTimeout);
+            if (segment == null)
+                return null;
+            if (segment[0].Length == 0)
             {
-                if (this.helper.HasExited)
-                    this.helper.Start();
+                // the end message can have the request info - speech gate, decoding model and real-time factor
+                if (segment.Length > 1)
+                    logger.Debug($"Transcription info: {System.Text.Encoding.UTF8.GetString(segment[1])}");
+                break;
+            }
+
+            result.Add(JArray.Parse(System.Text.Encoding.UTF8.GetString(segment[0])));
+            MyHome.Instance.Events.Fire(this, GlobalEventTypes.AssistantTranscription, string.Join("", result.Select(i => i[2])));
+        }
+        return result;
+    }
+
+    // returns the PCM samples position and format of WAV data, or the whole data as 16 kHz mono 16-bit PCM,
+    // null if the WAV samples aren't in supported format
+    private static (int offset, int length, int sampleRate, string format, int channels)? ParseWav(byte[] data)
+    {
+        var result = (offset: 0, length: data.Length, sampleRate: 16000, format: "s16le", channels: 1);
+        if (data.Length < 12 || System.Text.Encoding.ASCII.GetString(data, 0, 4) != "RIFF" ||
+            System.Text.Encoding.ASCII.GetString(data, 8, 4) != "WAVE")
+        {
+            return result;
+        }
 
-                this.helper.StandardInput.WriteLine("transcribe");
-                this.helper.StandardInput.WriteLine(Convert.ToBase64String(data));
-                var result = this.helper.StandardOutput.ReadLine();
-                if (result == null)
+        var position = 12;
+        while (position + 8 <= data.Length)
+        {
+            var chunkId = System.Text.Encoding.ASCII.GetString(data, position, 4);
+            var chunkSize = BitConverter.ToInt32(data, position + 4);
+            position += 8;
+            if (chunkId == "fmt " && position + 16 <= data.Length)
+            {
+                var audioFormat = BitConverter.ToUInt16(data, position); // 1 - PCM, 3 - float, 0xFFFE - extensible
+                result.channels = BitConverter.ToInt16(data, position + 2);
+                result.sampleRate = BitConverter.ToInt32(data, position + 4);
+                var bitsPerSample = BitConverter.ToInt16(data, position + 14);
+                if (audioFormat == 0xFFFE && chunkSize >= 40 && position + 40 <= data.Length &&
+                    data.AsSpan(position + 26, 14).SequenceEqual(WaveSubFormatSuffix))
                 {
-                    this.helper.Kill();
-                    return null;
+                    audioFormat = BitConverter.ToUInt16(data, position + 24); // the first bytes of the sub-format GUID
                 }
-
-                result = System.Text.Encoding.UTF8.GetString(Convert.FromBase64String(result[2..(result.Length - 1)])); // remove b' '
-                return JArray.Parse(result);
+                result.format = (audioFormat, bitsPerSample) switch
+                {
+                    (1, 8) => "u8",
+                    (1, 16) => "s16le",
+                    (1, 24) => "s24le",
+                    (1, 32) => "s32le",
+                    (3, 32) => "f32le",
+                    _ => null
+                };
+                if (result.format == null)
+                    return null;
             }
-            finally
+            else if (chunkId == "data")
             {
-                Monitor.Exit(this.helperLock);
+                result.offset = position;
+                result.length = Math.Min(chunkSize, data.Length - position); // the size could be unknown while recording
+                if (result.length < 0)
+                    result.length = data.Length - position;
+                break;
             }
+            if (chunkSize < 0)
+                break;
+            position += chunkSize + (chunkSize % 2); // chunks are word aligned
         }
-        this.helper.Kill();
-        return null;
+        return result;
     }
 
     private void SpeakResponse(string response, string roomName)
@@ -242,33 +309,15 @@ private void SpeakResponse(string response, string roomName)
             return;
         }
 
-        if (Monitor.TryEnter(this.helperLock, TimeSpan.FromSeconds(10)))
-        {
-            try
-            {
-                if (this.helper.HasExited)
-                    this.helper.Start();
-
-                this.helper.StandardInput.WriteLine("synthesize");
-                this.helper.StandardInput.WriteLine(Convert.ToBase64String(System.Text.Encoding.UTF8.GetBytes(response)));
-                var result = this.helper.StandardOutput.ReadLine();
-                if (result == null)
-                {
-                    this.helper.Kill();
-                    return;
-                }
+        using var request = this.helper.Send("synthesize", System.Text.Encoding.UTF8.GetBytes(response));
+        var values = request?.Read(1, HelperTimeout);
+        if (values == null || values[0].Length == 0)
+            return;
 
-                var bytes = Convert.FromBase64String(result[2..(result.Length - 1)]); // remove b' '
-                this.SpeakResponses[response.GetHashCode().ToString() + ".wav"] = (DateTime.Now, bytes);
+        // content hash (string.GetHashCode is randomized per process)
+        var name = Convert.ToHexString(System.Security.Cryptography.SHA256.HashData(System.Text.Encoding.UTF8.GetBytes(response)))[..16] + ".wav";
+        this.SpeakResponses[name] = (DateTime.Now, values[0]);
 
-                speaker.PlaySong(response.GetHashCode().ToString() + ".wav");
-            }
-            finally
-            {
-                Monitor.Exit(this.helperLock);
-            }
-        }
-        else
-            this.helper.Kill();
+        speaker.PlaySong(name);
     }
 }
\ No newline at end of file
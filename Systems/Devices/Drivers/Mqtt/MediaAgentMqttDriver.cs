@@ -18,6 +18,7 @@ public class MediaAgentMqttDriver : MqttDriver, IMediaDriver
         private static readonly Logger logger = LogManager.GetCurrentClassLogger();
 
         private const string MEDIA_LIST_STATE_NAME = "MediaList";
+        private const string MEDIA_LIST_DELTA_STATE_NAME = "MediaListDelta";
         private const string PLAYING_STATE_NAME = "Playing";
         private const string STATE_STATE_NAME = "State";
         private const string VOLUME_STATE_NAME = "Volume";
@@ -75,6 +76,7 @@ public string AgentHostName
                 this.agentHostName = value;
 
                 this.SetGetTopic(MEDIA_LIST_STATE_NAME, ($"tele/{this.agentHostName}/MEDIA_LIST", ""));
+                this.SetGetTopic(MEDIA_LIST_DELTA_STATE_NAME, ($"tele/{this.agentHostName}/MEDIA_LIST_DELTA", ""));
                 this.SetGetTopic(PLAYING_STATE_NAME, ($"tele/{this.agentHostName}/MEDIA", "playing"));
                 this.SetGetTopic(STATE_STATE_NAME, ($"tele/{this.agentHostName}/MEDIA", "state"));
                 this.SetGetTopic(VOLUME_STATE_NAME, ($"tele/{this.agentHostName}/MEDIA", "volume"));
@@ -91,6 +93,7 @@ public string AgentHostName
         public MediaAgentMqttDriver()
         {
             this.States.Add(MEDIA_LIST_STATE_NAME, "{}");
+            this.States.Add(MEDIA_LIST_DELTA_STATE_NAME, "{}");
             this.States.Add(PLAYING_STATE_NAME, "");
             this.States.Add(STATE_STATE_NAME, null);
             this.States.Add(VOLUME_STATE_NAME, 50);
@@ -98,6 +101,7 @@ public MediaAgentMqttDriver()
             this.States.Add(LENGTH_STATE_NAME, -1L);
 
             this.MqttGetTopics.Add(MEDIA_LIST_STATE_NAME, ("", ""));
+            this.MqttGetTopics.Add(MEDIA_LIST_DELTA_STATE_NAME, ("", ""));
             this.MqttGetTopics.Add(PLAYING_STATE_NAME, ("", ""));
             this.MqttGetTopics.Add(STATE_STATE_NAME, ("", ""));
             this.MqttGetTopics.Add(VOLUME_STATE_NAME, ("", ""));
@@ -224,9 +228,29 @@ protected override bool NewStateReceived(string name, object oldValue, object ne
             base.NewStateReceived(name, oldValue, newValue);
             if (name == VOLUME_STATE_NAME && (int)newValue == -1) // on stop volume is set to -1
                 this.States[VOLUME_STATE_NAME] = oldValue;
+            else if (name == MEDIA_LIST_DELTA_STATE_NAME)
+                this.ApplyMediaListDelta((string)newValue);
             return false; // don't save
         }
 
+        private void ApplyMediaListDelta(string delta)
+        {
+            // { media path: { "added": [[path, last modified date]], "removed": [path] } }, modified files are in both
+            var list = JObject.Parse((string)this.States[MEDIA_LIST_STATE_NAME]);
+            foreach (var p in JObject.Parse(delta).Properties())
+            {
+                if (list[p.Name] is not JArray files)
+                    list[p.Name] = files = new JArray();
+
+                var removed = (p.Value["removed"] ?? new JArray()).Select(t => (string)t).ToHashSet();
+                foreach (var file in files.Where(t => removed.Contains((string)t[0])).ToList())
+                    file.Remove();
+                foreach (var file in p.Value["added"] ?? new JArray())
+                    files.Add(file);
+            }
+            this.States[MEDIA_LIST_STATE_NAME] = list.ToString(Formatting.None);
+        }
+
         private Dictionary<string, List<string>> GetMediaList()
         {
             var result = new Dictionary<string, List<string>>();
@@ -3,6 +3,7 @@
 using System.Diagnostics;
 using System.IO;
 using System.Linq;
+using System.Text;
 using System.Threading;
 using System.Threading.Tasks;
 using System.Xml;
@@ -15,6 +16,7 @@
 using MyHome.Utils;
 
 using Newtonsoft.Json;
+using Newtonsoft.Json.Linq;
 
 using NLog;
 
@@ -26,7 +28,10 @@ public class Camera : BaseSensor
     {
         private static readonly ILogger logger = LogManager.GetCurrentClassLogger();
 
-        private const int ArchiveImagesCount = 300;
+        private const int RecordFps = 5; // a day of minute frames plays in ~5 minutes
+        private static readonly TimeSpan CaptureTimeout = TimeSpan.FromSeconds(10); // wait for a capture response
+        private static readonly TimeSpan SubStreamRetryInterval = TimeSpan.FromMinutes(10); // resolve the sub-stream again
+        private const int CaptureMaxTimeouts = 3; // restart the shared capture process if it doesn't respond so many times in a row
 
         public enum Movement
         {
@@ -51,18 +56,17 @@ public enum Movement
         [UiProperty(true)]
         public bool Record { get; set; }
 
+        [UiProperty(true, "low resolution ONVIF profile for previews and motion")]
+        public bool UseSubStream { get; set; }
 
-        private readonly object captureLock = new();
-        private Process capture;
-        private Process Capture
-        {
-            get
-            {
-                if (this.capture.HasExited)
-                    this.capture.Start();
-                return this.capture;
-            }
-        }
+
+        private static readonly Dictionary<HelperProcess, int> capturePool = new(); // capture process shared between cameras / cameras count
+        private static readonly Dictionary<HelperProcess, int> captureTimeouts = new(); // capture process / record requests without response in a row
+
+        private HelperProcess capture;
+        private string captureAddress;
+        private string subStreamAddress;
+        private DateTime subStreamResolveTime;
 
 
         private DateTime lastOnline;
@@ -95,9 +99,9 @@ public override void Setup()
         {
             base.Setup();
 
-            this.capture = Utils.Utils.StartProcess("python3", "External/cameraCapture.py", logger: logger);
+            this.capture = AcquireCaptureProcess();
             // prepare capture by opening
-            Task.Delay(TimeSpan.FromMinutes(1)).ContinueWith(_ => { lock (this.captureLock) this.IsOpened(); });
+            Task.Delay(TimeSpan.FromMinutes(1)).ContinueWith(_ => this.IsOpened());
 
             var recordThread = new Thread(this.RecordLoop)
             {
@@ -111,12 +115,9 @@ public override void Stop()
         {
             base.Stop();
             this.stopped = true;
-            if (!this.capture.HasExited)
-            {
-                this.capture.StandardInput.WriteLine("exit"); // stop camera capture process
-                if (!this.capture.HasExited)
-                    this.capture.Kill();
-            }
+            if (this.captureAddress != null)
+                this.capture.Send($"release {this.captureAddress}")?.Dispose(); // the response isn't needed
+            ReleaseCaptureProcess(this.capture); // stop camera capture process if no other camera use it
         }
 
         public override void Update()
@@ -142,14 +143,16 @@ public override void Update()
                     .Details($"'{this.Name}' ({this.Room.Name})")
                     .Validity(TimeSpan.FromDays(1))
                     .SendAlert();
-                this.capture.Kill();
+                // the capture process is shared with the other cameras, so reopen only this one (stuck process is restarted by CountCaptureTimeout)
+                if (this.captureAddress != null)
+                    this.capture.Send($"release {this.captureAddress}")?.Dispose();
             }
         }
 
         private void RecordLoop()
         {
             var path = Path.Combine(MyHome.Instance.Config.CameraRecordsPath, $"{this.Room.Name}_{this.Name}");
-            Directory.CreateDirectory(path);
+            Directory.CreateDirectory(Path.Combine(path, "segments"));
 
             Stopwatch sw = Stopwatch.StartNew();
             while (!this.stopped)
@@ -160,7 +163,7 @@ private void RecordLoop()
                     try
                     {
                         this.DropOldFrames();
-                        this.SaveImage(Path.Combine(path, $"{this.Room.Name}_{this.Name}_{DateTime.Now:HH-mm}.jpg"), false);
+                        this.RecordImage(Path.Combine(path, "segments", $"{this.Room.Name}_{this.Name}"));
                         this.lastImageSaved = DateTime.Now;
 
                         if (DateTime.Now.Hour == 23 && DateTime.Now.Minute == 59) // if we are in the end of a day
@@ -182,48 +185,101 @@ private void RecordLoop()
         // use only in Task, can block
         public bool IsOpened()
         {
-            var address = int.TryParse(this.Address, out int device) ? device.ToString() : this.GetStreamAddress();
+            // resolve the address before taking the lock of the shared process
+            var address = this.GetCaptureAddress();
             if (string.IsNullOrEmpty(address))
                 return false;
-            this.Capture.StandardInput.WriteLine($"isOpened {address}");
-            return this.Capture.StandardOutput.ReadLine() == "True";
+
+            // the capture process forgets the sub-stream if it is restarted, so set it every time
+            if (this.UseSubStream)
+            {
+                // not resolved or failed (e.g. ONVIF didn't respond), try again after a while
+                if (string.IsNullOrEmpty(this.subStreamAddress) && DateTime.Now - this.subStreamResolveTime > SubStreamRetryInterval)
+                {
+                    this.subStreamAddress = this.GetStreamAddress(1);
+                    this.subStreamResolveTime = DateTime.Now;
+                }
+                if (!string.IsNullOrEmpty(this.subStreamAddress))
+                    this.capture.Send($"subStream {address} {this.subStreamAddress}")?.Dispose(); // the response isn't needed
+            }
+
+            using var request = this.capture.Send($"isOpened {address}");
+            return request?.ReadString(CaptureTimeout) == "True";
         }
 
         // use only in Task, can block
-        public byte[] GetImage(bool initIfEmpty = true, (int width, int height)? size = null, bool timestamp = true)
+        // format - jpg, webp or png, quality - 0-100
+        public byte[] GetImage(bool initIfEmpty = true, (int width, int height)? size = null, bool timestamp = true,
+            string format = "jpg", int quality = 95)
         {
-            if (Monitor.TryEnter(this.captureLock, TimeSpan.FromSeconds(5)))
+            var address = this.GetCaptureAddress();
+            if (string.IsNullOrEmpty(address))
+                return null;
+
+            var _size = size.HasValue ? $"{size.Value.width},{size.Value.height}" : "None";
+            using var request = this.capture.Send($"getImage {address} {initIfEmpty} {_size} {timestamp} {format} {quality}");
+            var values = request?.Read(2, CaptureTimeout);
+            if (values == null || values[1].Length == 0) // no image from the camera
+                return null;
+
+            if (Encoding.UTF8.GetString(values[0]) == "True")
+                this.lastOnline = DateTime.Now;
+            return values[1];
+        }
+
+        // use only in Task, can block
+        // images written by the capture process to a shared memory ring at the target FPS, shared with the other viewers of the camera
+        // without the ring (e.g. no /dev/shm) the frames are pushed through the pipe, the older protocol versions poll the images
+        public IEnumerable<byte[]> StreamImages(int fps, (int width, int height)? size, int quality, CancellationToken token)
+        {
+            var interval = TimeSpan.FromSeconds(1.0 / fps);
+            while (!token.IsCancellationRequested)
             {
+                var (ring, shareId) = this.ShareImages(fps, size, quality);
+                if (ring == null && this.capture.IsPipelined && !string.IsNullOrEmpty(this.captureAddress))
+                {
+                    foreach (var image in this.SubscribeImages(fps, size, quality, token))
+                        yield return image;
+                    if (!token.IsCancellationRequested)
+                        token.WaitHandle.WaitOne(TimeSpan.FromSeconds(1)); // wait the process to restart
+                    continue;
+                }
+                if (ring == null)
+                {
+                    // streaming isn't supported, poll the images
+                    var sw = Stopwatch.StartNew();
+                    yield return this.GetImage(true, size, true, "jpg", quality) ?? [];
+                    if (sw.Elapsed < interval)
+                        Thread.Sleep(interval - sw.Elapsed);
+                    continue;
+                }
+
                 try
                 {
-                    var address = int.TryParse(this.Address, out int device) ? device.ToString() : this.GetStreamAddress();
-                    if (string.IsNullOrEmpty(address))
-                        return null;
-                    var _size = size.HasValue ? $"{size.Value.width},{size.Value.height}" : "None";
-                    this.Capture.StandardInput.WriteLine($"getImage {address} {initIfEmpty} {_size} {timestamp}");
-                    var res = this.Capture.StandardOutput.ReadLine();
-                    if (res == null)
+                    long sequence = 0;
+                    var lastFrame = Stopwatch.StartNew();
+                    while (!token.IsCancellationRequested && lastFrame.Elapsed < CaptureTimeout) // no frames if the process has exited
                     {
-                        this.capture.Kill();
-                        return null;
+                        var frame = ring.ReadLatest(sequence);
+                        if (frame.data == null)
+                        {
+                            Thread.Sleep(interval / 4);
+                            continue;
+                        }
+
+                        sequence = frame.sequence;
+                        lastFrame.Restart();
+                        if (frame.result)
+                            this.lastOnline = DateTime.Now;
+                        yield return frame.data;
                     }
-                    var img = this.Capture.StandardOutput.ReadLine();
-                    if (string.IsNullOrEmpty(img))
-                    {
-                        this.capture.Kill();
-                        return null;
-                    }
-
-                    if (res == "True")
-                        this.lastOnline = DateTime.Now;
-                    return Convert.FromBase64String(img[2..(img.Length - 1)]); // remove b' '
                 }
                 finally
                 {
-                    Monitor.Exit(this.captureLock);
+                    this.capture.Send($"unsubscribe {shareId}")?.Dispose();
+                    ring.Dispose();
                 }
             }
-            return null;
         }
 
         // use only in Task, can block
@@ -250,10 +306,22 @@ public bool SaveImage(string filepath, bool initIfEmpty = true, (int width, int
 
         public double DiffImages(byte[] image1, byte[] image2)
         {
-            this.Capture.StandardInput.WriteLine("diffImages");
-            this.Capture.StandardInput.WriteLine(Convert.ToBase64String(image1));
-            this.Capture.StandardInput.WriteLine(Convert.ToBase64String(image2));
-            return double.Parse(this.Capture.StandardOutput.ReadLine());
+            using var request = this.capture.Send("diffImages", image1, image2);
+            var res = request?.ReadString(CaptureTimeout);
+            return res != null ? double.Parse(res, System.Globalization.CultureInfo.InvariantCulture) : -1;
+        }
+
+        // use only in Task, can block
+        // returns changed part of the image since the last movement (reference) or -1 if there is no image
+        public double DetectMotion(double threshold)
+        {
+            var address = this.GetCaptureAddress();
+            if (string.IsNullOrEmpty(address))
+                return -1;
+
+            using var request = this.capture.Send(FormattableString.Invariant($"motion {address} {threshold}"));
+            var res = request?.ReadString(CaptureTimeout);
+            return double.TryParse(res, System.Globalization.NumberStyles.Float, System.Globalization.CultureInfo.InvariantCulture, out var value) ? value : -1;
         }
 
         public void Move(Movement movement)
@@ -324,11 +392,72 @@ public bool Restart()
         }
 
 
-        private string GetStreamAddress()
+        // images pushed by the capture process through the pipe until the end of the stream or the process exit
+        private IEnumerable<byte[]> SubscribeImages(int fps, (int width, int height)? size, int quality, CancellationToken token)
+        {
+            var _size = size.HasValue ? $"{size.Value.width},{size.Value.height}" : "None";
+            var request = this.capture.Send($"subscribe {this.captureAddress} {fps} {_size} {quality}");
+            if (request == null)
+                yield break;
+
+            try
+            {
+                while (!token.IsCancellationRequested)
+                {
+                    var values = request.ReadLatest(2, CaptureTimeout);
+                    if (values == null) // end of the stream or the process has exited
+                        break;
+
+                    if (Encoding.UTF8.GetString(values[0]) == "True")
+                        this.lastOnline = DateTime.Now;
+                    yield return values[1];
+                }
+            }
+            finally
+            {
+                this.capture.Send($"unsubscribe {request.Id}")?.Dispose();
+                request.Dispose();
+            }
+        }
+
+        // returns null ring if it isn't supported by the capture process
+        private (FrameRingReader ring, int shareId) ShareImages(int fps, (int width, int height)? size, int quality)
+        {
+            var address = this.GetCaptureAddress();
+            if (string.IsNullOrEmpty(address) || !this.capture.IsPipelined)
+                return (null, 0);
+
+            var _size = size.HasValue ? $"{size.Value.width},{size.Value.height}" : "None";
+            using var request = this.capture.Send($"share {address} {fps} {_size} {quality}");
+            var path = request?.ReadString(CaptureTimeout);
+            if (string.IsNullOrEmpty(path))
+                return (null, 0);
+
+            try
+            {
+                return (new FrameRingReader(path), request.Id);
+            }
+            catch (Exception e)
+            {
+                logger.Error($"Cannot open shared images of camera '{this.Name}' ({this.Room.Name})");
+                logger.Debug(e);
+                this.capture.Send($"unsubscribe {request.Id}")?.Dispose();
+                return (null, 0);
+            }
+        }
+
+        private string GetCaptureAddress()
+        {
+            this.captureAddress = int.TryParse(this.Address, out int device) ? device.ToString() : this.GetStreamAddress();
+            return this.captureAddress;
+        }
+
+        // profile - index of the ONVIF media profile, the second one is usually the sub-stream
+        private string GetStreamAddress(int profile = 0)
         {
             // rtsp://192.168.0.120:554/user=admin_password=12345_channel=1_stream=0.sdp?real_stream
             if (this.Address.StartsWith("rtsp://") || !this.IsOnvifSupported)
-                return this.Address;
+                return profile == 0 ? this.Address : null;
 
             try
             {
@@ -341,7 +470,10 @@ private string GetStreamAddress()
                         Protocol = Mictlanix.DotNet.Onvif.Common.TransportProtocol.RTSP
                     }
                 };
-                var token = this.GetOnvif<Mictlanix.DotNet.Onvif.Common.Profile>().token;
+                var token = profile == 0 ? this.GetOnvif<Mictlanix.DotNet.Onvif.Common.Profile>().token :
+                    media.GetProfilesAsync().WaitAsync(TimeSpan.FromSeconds(3)).Result.Profiles.ElementAtOrDefault(profile)?.token;
+                if (token == null)
+                    return null;
                 var response = media.GetStreamUriAsync(streamSetup, token).Result.Uri;
                 // replace internal IP address with the real one
                 var responseIp = response[7..response.IndexOf(":", 7)];
@@ -433,37 +565,133 @@ private string GetStreamAddress()
 
         private void ArchiveRecords()
         {
-            // get images older than 24 hours
-            var path = Path.Combine(MyHome.Instance.Config.CameraRecordsPath, $"{this.Room.Name}_{this.Name}");
-            var images = Directory.GetFiles(path, "*.jpg")
-                .Select(f => new FileInfo(f)).Where(f => f.CreationTime >= DateTime.Now.AddHours(-24)).OrderBy(f => f.CreationTime)
-                .Select(f => f.FullName).ToList();
-            if (images.Count > ArchiveImagesCount)
+            // close the current segment, so it is complete for the concatenation
+            var address = this.GetCaptureAddress();
+            if (!string.IsNullOrEmpty(address))
             {
-                // leave only every Nth element if images are too many
-                var step = (images.Count / ArchiveImagesCount) + 1;
-                images = images.Where((x, i) => i % step == 0).ToList();
+                using var request = this.capture.Send($"recordClose {address}");
+                request?.Read(1, CaptureTimeout);
             }
 
-            var videoFilename = $"{this.Room.Name}_{this.Name}_{DateTime.Now.Date:yyyy-MM-dd}.mp4";
-            Services.CreateVideo(images, Path.Join(path, videoFilename));
+            // segment names start with the camera name and end with their start time (_yyyy-MM-dd_HH-mm),
+            // a video per day, so segments left from a previous day aren't archived with the current one
+            var path = Path.Combine(MyHome.Instance.Config.CameraRecordsPath, $"{this.Room.Name}_{this.Name}");
+            var days = Directory.GetFiles(Path.Combine(path, "segments"), "*.mp4").Order()
+                .GroupBy(f => Path.GetFileNameWithoutExtension(f).Split('_')[^2]);
+            foreach (var day in days)
+            {
+                var segments = day.ToList();
+                var videoFilename = $"{this.Room.Name}_{this.Name}_{day.Key}.mp4";
+                if (!File.Exists(Path.Join(path, videoFilename)) && Services.ConcatVideos(segments, Path.Join(path, videoFilename)))
+                {
+                    segments.ForEach(File.Delete);
+                    continue;
+                }
+
+                // keep the segments as separate videos of the day, so they aren't lost or concatenated again
+                logger.Warn($"Camera '{this.Name}' ({this.Room.Name}) records of {day.Key} are kept as {segments.Count} segments");
+                foreach (var segment in segments)
+                    File.Move(segment, Path.Join(path, Path.GetFileName(segment)), true);
+            }
 
-            // cleanup cameras records
+            // cleanup cameras records, not the segments which are still recorded
             Utils.Utils.CleanupFilesByCapacity(
                 Directory.GetFiles(path, "*.mp4")
                     .Select(f => new FileInfo(f)).OrderBy(f => f.CreationTime),
                 MyHome.Instance.Config.CameraRecordsDiskUsage, logger);
         }
 
+        // append the current image to the hourly video segment, written by the capture process directly
+        private bool RecordImage(string pathPrefix)
+        {
+            var address = this.GetCaptureAddress();
+            if (string.IsNullOrEmpty(address))
+                return false;
+
+            using var request = this.capture.Send($"record {address} {RecordFps}", Encoding.UTF8.GetBytes(pathPrefix));
+            var response = request?.ReadString(CaptureTimeout);
+            if (request != null)
+                CountCaptureTimeout(this.capture, response == null);
+            var recorded = response == "True";
+            if (!recorded)
+                logger.Debug($"Camera '{this.Name}' ({this.Room.Name}) failed to record image: {pathPrefix}");
+            return recorded;
+        }
+
         private void DropOldFrames()
         {
-            lock (this.captureLock)
+            var address = this.GetCaptureAddress();
+            if (string.IsNullOrEmpty(address))
+                return;
+
+            using var request = this.capture.Send($"dropOldFrames {address}");
+            logger.Trace("Dropped old frames: " + request?.ReadString(CaptureTimeout));
+        }
+
+
+        private static HelperProcess AcquireCaptureProcess()
+        {
+            lock (capturePool)
             {
-                var address = int.TryParse(this.Address, out int device) ? device.ToString() : this.GetStreamAddress();
-                if (string.IsNullOrEmpty(address))
+                // fill the pool first, then use the least used process
+                HelperProcess process;
+                if (capturePool.Count < Math.Max(1, MyHome.Instance.Config.CameraCaptureProcesses))
+                {
+                    var captureArgs = MyHome.Instance.Config.CameraBackgroundCapture ? " --grab" : "";
+                    // OpenCV and FFmpeg write warnings for unreachable cameras, they must not stop the process of all cameras
+                    process = new HelperProcess("python3", "External/cameraCapture.py" + captureArgs, killOnError: false, logger: logger);
+                    process.EnsureStarted();
+                    capturePool.Add(process, 0);
+                }
+                else
+                    process = capturePool.MinBy(kvp => kvp.Value).Key;
+
+                capturePool[process]++;
+                return process;
+            }
+        }
+
+        // stats of every capture process
+        public static List<JToken> GetCaptureStats()
+        {
+            List<HelperProcess> processes;
+            lock (capturePool)
+                processes = capturePool.Keys.ToList();
+
+            return processes.Select(process => Utils.Utils.TryParseJson(process.GetStats(CaptureTimeout), out var stats) ? stats : null)
+                .ToList();
+        }
+
+        // the pipelined process isn't killed on a timeout, so restart it here if it is stuck,
+        // a slow camera read could time out too, so the process must not respond to stats either
+        private static void CountCaptureTimeout(HelperProcess process, bool timedOut)
+        {
+            if (timedOut && process.GetStats(CaptureTimeout) != null)
+                timedOut = false;
+
+            lock (capturePool)
+            {
+                if (!capturePool.ContainsKey(process)) // released meanwhile
+                    return;
+                var count = timedOut ? captureTimeouts.GetValueOrDefault(process) + 1 : 0;
+                captureTimeouts[process] = count < CaptureMaxTimeouts ? count : 0;
+                if (count < CaptureMaxTimeouts)
                     return;
-                this.Capture.StandardInput.WriteLine($"dropOldFrames {address}");
-                logger.Trace("Dropped old frames: " + this.Capture.StandardOutput.ReadLine());
+            }
+            logger.Warn("Camera capture process doesn't respond, restart it");
+            process.Kill(); // started again on next request
+        }
+
+        private static void ReleaseCaptureProcess(HelperProcess process)
+        {
+            lock (capturePool)
+            {
+                if (!capturePool.ContainsKey(process) || --capturePool[process] > 0)
+                    return;
+
+                capturePool.Remove(process);
+                captureTimeouts.Remove(process);
+                process.Stop();
             }
         }
     }
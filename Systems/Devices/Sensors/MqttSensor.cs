@@ -100,7 +100,11 @@ private void MqttClient_ApplicationMessageReceived(object sender, MqttApplicatio
                         value = (string)value == "ON";
                     data.Add(!string.IsNullOrEmpty(jsonPath) ? jsonPath : topic, value);
                 }
-                this.AddData(DateTime.Now, data);
+                // late (replayed) values carry their own time
+                var time = DateTime.Now;
+                if (json.Type == JTokenType.Object && (bool?)json["Replay"] == true && json["Time"]?.Type == JTokenType.Date)
+                    time = (DateTime)json["Time"];
+                this.AddData(time, data);
             }
             catch (Exception ex)
             {
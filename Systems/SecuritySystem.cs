@@ -70,7 +70,7 @@ private sealed class RoomInfo
         [JsonProperty]
         private readonly List<RoomInfo> roomsInfo;
 
-        private readonly Dictionary<string, byte[]> prevImages;
+        private readonly HashSet<string> motionCameras; // cameras with motion reference image
 
         private DateTime presenceDetectionTimer;
 
@@ -87,7 +87,7 @@ public SecuritySystem()
             this.Present = new List<string>();
 
             this.roomsInfo = new List<RoomInfo>();
-            this.prevImages = new Dictionary<string, byte[]>();
+            this.motionCameras = new HashSet<string>();
             this.presenceDetectionTimer = DateTime.Now - TimeSpan.FromMinutes(this.PresenceDetectionInterval);
 
             Directory.CreateDirectory(MyHome.Instance.Config.CameraRecordsPath);
@@ -166,7 +166,7 @@ public void Activate(Room room)
                 roomInfo.Activated = true;
                 roomInfo.StartTime = DateTime.Now;
                 foreach (var camera in roomInfo.Room.Cameras)
-                    this.prevImages.Remove(camera.Room.Name + "." + camera.Name);
+                    this.motionCameras.Remove(camera.Room.Name + "." + camera.Name);
 
                 // play security alarm on speakers if no presence detected
                 Task.Delay(TimeSpan.FromMinutes(this.PresenceDetectionInterval * 3)).ContinueWith(t =>
@@ -267,17 +267,16 @@ protected override void Update()
 
         private void SaveImage(Camera camera, RoomInfo roomInfo)
         {
+            // if no movement since the previous saved image - skip saving (the first image is always saved)
+            var key = camera.Room.Name + "." + camera.Name;
+            var threshold = this.motionCameras.Contains(key) ? this.MovementThreshold : 0.0;
+            if (camera.DetectMotion(threshold) < threshold)
+                return;
+
             var image = camera.GetImage(false);
             if (image == null)
                 return;
-            if (this.prevImages.ContainsKey(camera.Room.Name + "." + camera.Name))
-            {
-                // if no movement between current and previous image - skip saving
-                var diffPercent = camera.DiffImages(this.prevImages[camera.Room.Name + "." + camera.Name], image);
-                if (diffPercent < this.MovementThreshold)
-                    return;
-            }
-            this.prevImages[camera.Room.Name + "." + camera.Name] = image;
+            this.motionCameras.Add(key);
 
             var filename = $"{camera.Room.Name}_{camera.Name}_{DateTime.Now:yyyy-MM-dd_HH-mm-ss}.jpg";
             var filepath = Path.Combine(MyHome.Instance.Config.CameraRecordsPath, filename);
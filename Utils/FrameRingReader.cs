@@ -0,0 +1,73 @@
+using System;
+using System.IO;
+using System.IO.MemoryMappedFiles;
+using System.Text;
+
+namespace MyHome.Utils
+{
+    /// <summary>
+    /// Reader of the memory-mapped frame ring written by External/cameraCapture.py ("share" command).
+    /// Header: magic, version, slots count, slot size, latest sequence; every slot: sequence, unix time, data length, result + data.
+    /// </summary>
+    public sealed class FrameRingReader : IDisposable
+    {
+        private const int HeaderSize = 24;
+        private const int LatestOffset = 16;
+        private const int SlotHeaderSize = 24;
+
+        private readonly MemoryMappedFile file;
+        private readonly MemoryMappedViewAccessor accessor;
+        private readonly int slots;
+        private readonly int slotSize;
+
+
+        public FrameRingReader(string path)
+        {
+            // the writer removes the file when the ring is closed, the mapping stays valid
+            using var stream = new FileStream(path, FileMode.Open, FileAccess.Read, FileShare.ReadWrite | FileShare.Delete);
+            this.file = MemoryMappedFile.CreateFromFile(stream, null, 0, MemoryMappedFileAccess.Read, HandleInheritability.None, false);
+            this.accessor = this.file.CreateViewAccessor(0, 0, MemoryMappedFileAccess.Read);
+
+            var magic = new byte[4];
+            this.accessor.ReadArray(0, magic, 0, magic.Length);
+            if (Encoding.ASCII.GetString(magic) != "MHFR")
+            {
+                this.Dispose();
+                throw new InvalidDataException($"Invalid frame ring: {path}");
+            }
+            this.slots = this.accessor.ReadInt32(8);
+            this.slotSize = this.accessor.ReadInt32(12);
+        }
+
+        public long LatestSequence => this.accessor.ReadInt64(LatestOffset);
+
+        // returns the latest frame if it's newer than the sequence, data is null otherwise
+        public (long sequence, DateTime time, bool result, byte[] data) ReadLatest(long afterSequence)
+        {
+            var sequence = this.LatestSequence;
+            if (sequence <= afterSequence)
+                return (afterSequence, default, false, null);
+
+            long offset = HeaderSize + (sequence % this.slots) * (SlotHeaderSize + this.slotSize);
+            if (this.accessor.ReadInt64(offset) != sequence) // the slot is being overwritten
+                return (afterSequence, default, false, null);
+
+            var time = DateTimeOffset.FromUnixTimeMilliseconds((long)(this.accessor.ReadDouble(offset + 8) * 1000)).LocalDateTime;
+            var length = Math.Min(this.accessor.ReadInt32(offset + 16), this.slotSize);
+            var result = this.accessor.ReadInt32(offset + 20) != 0;
+            var data = new byte[length];
+            this.accessor.ReadArray(offset + SlotHeaderSize, data, 0, length);
+
+            // the slot could be overwritten while copying
+            if (this.accessor.ReadInt64(offset) != sequence)
+                return (afterSequence, default, false, null);
+            return (sequence, time, result, data);
+        }
+
+        public void Dispose()
+        {
+            this.accessor?.Dispose();
+            this.file?.Dispose();
+        }
+    }
+}
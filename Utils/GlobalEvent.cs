@@ -25,7 +25,8 @@ public enum GlobalEventTypes
         SensorDataAdded,
         DriverStateChanged,
 
-        AssistantResponse
+        AssistantResponse,
+        AssistantTranscription
     }
 
     public class GlobalEventArgs : EventArgs
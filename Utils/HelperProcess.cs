@@ -0,0 +1,333 @@
+using System;
+using System.Buffers.Binary;
+using System.Collections.Concurrent;
+using System.Diagnostics;
+using System.IO;
+using System.Text;
+using System.Threading;
+
+using NLog;
+
+namespace MyHome.Utils
+{
+    /// <summary>
+    /// Python helper process (External/*.py) which communicates through the helper protocol (External/helperProtocol.py).
+    /// Requests are text lines, responses are text lines (version 1), length-prefixed binary frames (version 2)
+    /// or messages tagged with the request id (version 3), so requests of different callers run in parallel.
+    /// </summary>
+    public class HelperProcess
+    {
+        public const int BinaryProtocolVersion = 2;
+        public const int PipelinedProtocolVersion = 3;
+
+        private readonly string fileName;
+        private readonly string arguments;
+        private readonly string workingDirectory;
+        private readonly bool killOnError;
+        private readonly ILogger logger;
+        private readonly int requestedVersion;
+
+        private readonly object writeLock = new();
+        private Process process;
+        private ConcurrentDictionary<int, BlockingCollection<byte[][]>> pending; // request id / responses
+        private int nextRequestId;
+
+        // not pipelined protocol - requests and responses of different callers must not interleave
+        public object SyncRoot { get; } = new();
+
+        public TimeSpan LockTimeout { get; set; } = TimeSpan.FromSeconds(5);
+
+        public int ProtocolVersion { get; private set; }
+
+        public bool IsBinary => this.ProtocolVersion >= BinaryProtocolVersion;
+
+        public bool IsPipelined => this.ProtocolVersion >= PipelinedProtocolVersion;
+
+        public bool HasExited => this.process == null || this.process.HasExited;
+
+
+        public HelperProcess(string fileName, string arguments, string workingDirectory = null,
+            bool killOnError = true, ILogger logger = null, int protocolVersion = PipelinedProtocolVersion)
+        {
+            this.fileName = fileName;
+            this.arguments = arguments;
+            this.workingDirectory = workingDirectory;
+            this.killOnError = killOnError;
+            this.logger = logger;
+            this.requestedVersion = protocolVersion;
+            this.ProtocolVersion = 1;
+        }
+
+        // start the process if it isn't running and negotiate the protocol version
+        public void EnsureStarted()
+        {
+            lock (this.writeLock)
+            {
+                if (!this.HasExited)
+                    return;
+
+                this.process = Utils.StartProcess(this.fileName, this.arguments, this.workingDirectory, this.killOnError, this.logger);
+                this.ProtocolVersion = 1;
+                if (this.requestedVersion > 1)
+                {
+                    this.process.StandardInput.WriteLine($"protocol {this.requestedVersion}");
+                    var response = this.process.StandardOutput.ReadLine();
+                    this.ProtocolVersion = int.TryParse(response, out var version) ? version : 1;
+                    this.logger?.Trace($"Helper process '{this.arguments}' protocol version: {this.ProtocolVersion}");
+                }
+
+                if (this.IsPipelined)
+                {
+                    // every process instance has its own reader thread and pending requests
+                    var process = this.process;
+                    var pending = new ConcurrentDictionary<int, BlockingCollection<byte[][]>>();
+                    this.pending = pending;
+                    new Thread(() => ReadResponses(process, pending))
+                    {
+                        Name = $"Helper reader {this.arguments}",
+                        IsBackground = true
+                    }.Start();
+                }
+            }
+        }
+
+        // send the request with binary arguments, dispose the result after reading the response
+        // returns null if the process is busy (not pipelined protocol) more than the lock timeout
+        public HelperRequest Send(string command, params byte[][] data)
+        {
+            this.EnsureStarted();
+            if (!this.IsPipelined)
+            {
+                if (!Monitor.TryEnter(this.SyncRoot, this.LockTimeout))
+                    return null;
+                try
+                {
+                    lock (this.writeLock)
+                        this.Write(command, data);
+                    return new HelperRequest(this, null, 0, null);
+                }
+                catch
+                {
+                    Monitor.Exit(this.SyncRoot);
+                    throw;
+                }
+            }
+
+            var id = Interlocked.Increment(ref this.nextRequestId);
+            var responses = new BlockingCollection<byte[][]>();
+            lock (this.writeLock)
+            {
+                var pending = this.pending;
+                pending[id] = responses;
+                if (this.HasExited) // the reader thread could already complete the pending requests
+                    responses.CompleteAdding();
+                else
+                    this.Write($"{id} {command}", data);
+                return new HelperRequest(this, pending, id, responses);
+            }
+        }
+
+        public void Stop()
+        {
+            if (this.HasExited)
+                return;
+
+            lock (this.writeLock)
+                this.process.StandardInput.WriteLine("exit");
+            if (!this.process.WaitForExit(1000))
+                this.process.Kill();
+        }
+
+        public void Kill()
+        {
+            if (!this.HasExited)
+                this.process.Kill();
+        }
+
+        // latency histograms per command and stage, memory and counters of the process as JSON, null if it doesn't respond
+        public string GetStats(TimeSpan timeout)
+        {
+            if (this.HasExited)
+                return null;
+
+            using var request = this.Send("stats");
+            return request?.ReadString(timeout);
+        }
+
+
+        private void Write(string line, byte[][] data)
+        {
+            this.process.StandardInput.WriteLine(line);
+            foreach (var item in data)
+            {
+                if (!this.IsBinary)
+                {
+                    this.process.StandardInput.WriteLine(Convert.ToBase64String(item));
+                    continue;
+                }
+
+                var header = new byte[4];
+                BinaryPrimitives.WriteUInt32BigEndian(header, (uint)item.Length);
+                var stream = this.process.StandardInput.BaseStream;
+                stream.Write(header);
+                stream.Write(item);
+                stream.Flush();
+            }
+        }
+
+        // read response values with not pipelined protocol, returns null if the process has exited
+        internal byte[][] ReadValues(int count)
+        {
+            var values = new byte[count][];
+            for (int i = 0; i < count; i++)
+            {
+                if (this.IsBinary)
+                {
+                    values[i] = ReadFrame(this.process.StandardOutput.BaseStream);
+                }
+                else
+                {
+                    var line = this.process.StandardOutput.ReadLine();
+                    if (line != null && line.StartsWith("b'") && line.EndsWith('\''))
+                        values[i] = Convert.FromBase64String(line[2..(line.Length - 1)]); // remove b' '
+                    else if (line != null)
+                        values[i] = Encoding.UTF8.GetBytes(line);
+                }
+                if (values[i] == null)
+                    return null;
+            }
+            return values;
+        }
+
+        private static void ReadResponses(Process process, ConcurrentDictionary<int, BlockingCollection<byte[][]>> pending)
+        {
+            try
+            {
+                var stream = process.StandardOutput.BaseStream;
+                var header = new byte[8];
+                while (ReadExactly(stream, header))
+                {
+                    var id = (int)BinaryPrimitives.ReadUInt32BigEndian(header);
+                    var values = new byte[BinaryPrimitives.ReadUInt32BigEndian(header.AsSpan(4))][];
+                    for (int i = 0; i < values.Length; i++)
+                    {
+                        values[i] = ReadFrame(stream);
+                        if (values[i] == null)
+                            return;
+                    }
+
+                    // responses of abandoned (timed out) requests are skipped
+                    if (pending.TryGetValue(id, out var responses) && !responses.IsAddingCompleted)
+                        responses.Add(values);
+                }
+            }
+            catch (Exception e) when (e is IOException || e is ObjectDisposedException)
+            {
+                // the process has exited
+            }
+            finally
+            {
+                foreach (var responses in pending.Values)
+                    responses.CompleteAdding();
+            }
+        }
+
+        private static byte[] ReadFrame(Stream stream)
+        {
+            var header = new byte[4];
+            if (!ReadExactly(stream, header))
+                return null;
+
+            var data = new byte[BinaryPrimitives.ReadUInt32BigEndian(header)];
+            return ReadExactly(stream, data) ? data : null;
+        }
+
+        private static bool ReadExactly(Stream stream, byte[] buffer)
+        {
+            try
+            {
+                stream.ReadExactly(buffer);
+                return true;
+            }
+            catch (EndOfStreamException)
+            {
+                return false;
+            }
+        }
+    }
+
+    /// <summary>
+    /// Request sent to a helper process, streaming commands can read multiple responses.
+    /// </summary>
+    public sealed class HelperRequest : IDisposable
+    {
+        private readonly HelperProcess helper;
+        private readonly ConcurrentDictionary<int, BlockingCollection<byte[][]>> pending;
+        private readonly int id;
+        private readonly BlockingCollection<byte[][]> responses;
+        private bool disposed;
+
+        public int Id => this.id;
+
+        internal HelperRequest(HelperProcess helper, ConcurrentDictionary<int, BlockingCollection<byte[][]>> pending,
+            int id, BlockingCollection<byte[][]> responses)
+        {
+            this.helper = helper;
+            this.pending = pending;
+            this.id = id;
+            this.responses = responses;
+        }
+
+        // returns the next response values, null on timeout or if the process has exited
+        public byte[][] Read(int count, TimeSpan timeout)
+        {
+            if (this.responses == null)
+            {
+                // not pipelined - a stuck process blocks everyone, so kill it (started again on next request)
+                var values = this.helper.ReadValues(count);
+                if (values == null)
+                    this.helper.Kill();
+                return values;
+            }
+
+            try
+            {
+                // a failed request gets an empty response
+                if (this.responses.TryTake(out var values, timeout) && values.Length >= count)
+                    return values;
+            }
+            catch (InvalidOperationException)
+            {
+                // the process has exited
+            }
+            return null;
+        }
+
+        // returns the newest response values and skips the older not read ones (e.g. frames of a stream)
+        public byte[][] ReadLatest(int count, TimeSpan timeout)
+        {
+            var values = this.Read(count, timeout);
+            while (values != null && this.responses != null && this.responses.TryTake(out var next))
+                values = next.Length >= count ? next : null;
+            return values;
+        }
+
+        public string ReadString(TimeSpan timeout)
+        {
+            var values = this.Read(1, timeout);
+            return values != null ? Encoding.UTF8.GetString(values[0]) : null;
+        }
+
+        public void Dispose()
+        {
+            if (this.disposed)
+                return;
+            this.disposed = true;
+
+            if (this.responses == null)
+                Monitor.Exit(this.helper.SyncRoot);
+            else
+                this.pending.TryRemove(this.id, out _);
+        }
+    }
+}
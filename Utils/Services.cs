@@ -203,19 +203,19 @@ public static async Task<string> DownloadYouTubeAudioAsync(string url, string pa
         }
 
         [System.Diagnostics.CodeAnalysis.SuppressMessage("Major Code Smell", "S112")]
-        public static bool CreateVideo(List<string> imageFilePaths, string outputFilePath)
+        public static bool ConcatVideos(List<string> videoFilePaths, string outputFilePath)
         {
-            if (imageFilePaths.Count == 0)
+            if (videoFilePaths.Count == 0)
             {
-                logger.Debug($"Skip creating video '{outputFilePath}' from {imageFilePaths.Count} images");
+                logger.Debug($"Skip concatenating video '{outputFilePath}' from {videoFilePaths.Count} videos");
                 return false;
             }
 
-            logger.Debug($"Creating video '{outputFilePath}' from {imageFilePaths.Count} images");
+            logger.Debug($"Concatenating video '{outputFilePath}' from {videoFilePaths.Count} videos");
             try
             {
                 var inputFilePath = Path.Join(Path.GetDirectoryName(outputFilePath), "list.txt");
-                File.WriteAllText(inputFilePath, string.Join("\n", imageFilePaths.Select(f => $"file '{f}'\nduration 1")));
+                File.WriteAllText(inputFilePath, string.Join("\n", videoFilePaths.Select(f => $"file '{f}'")));
 
                 var ffmpegProcess = new System.Diagnostics.Process();
                 ffmpegProcess.StartInfo.UseShellExecute = false;
@@ -224,8 +224,8 @@ public static bool CreateVideo(List<string> imageFilePaths, string outputFilePat
                 ffmpegProcess.StartInfo.RedirectStandardError = true;
                 ffmpegProcess.StartInfo.CreateNoWindow = true;
                 ffmpegProcess.StartInfo.FileName = "ffmpeg";
-                // "-c:v h264_v4l2m2m -pix_fmt yuv420p" to use Raspberry Pi hardware acceleration
-                ffmpegProcess.StartInfo.Arguments = $" -f concat -safe 0 -i \"{inputFilePath}\" -c:v h264_v4l2m2m -pix_fmt yuv420p -y \"{outputFilePath}\"";
+                // copy the streams without re-encoding, the segments have the same format
+                ffmpegProcess.StartInfo.Arguments = $" -f concat -safe 0 -i \"{inputFilePath}\" -c copy -y \"{outputFilePath}\"";
                 ffmpegProcess.Start();
 
                 var stdErr = new StringBuilder();
@@ -238,7 +238,7 @@ public static bool CreateVideo(List<string> imageFilePaths, string outputFilePat
             }
             catch (Exception e)
             {
-                logger.Error($"Failed to create video '{outputFilePath}' from {imageFilePaths.Count} images");
+                logger.Error($"Failed to concatenate video '{outputFilePath}' from {videoFilePaths.Count} videos");
                 logger.Debug(e);
                 return false;
             }